@@ -1,182 +1,282 @@
-import asyncio
-from typing import Dict, Optional
-from urllib.parse import quote
-
-from pypinyin import lazy_pinyin, Style
-
-from util.resource import Resource, Character, ServerError
-from util.cc import s2t
-
-
-def available_avatar_names(entries: list) -> set:
-    """Extract the base names of top-level .png blobs from a git tree listing."""
-    names = set()
-    for entry in entries or []:
-        if entry.get('type') != 'blob':
-            continue
-        path = entry.get('path')
-        if isinstance(path, str) and path.endswith('.png'):
-            names.add(path[:-4])
-    return names
-
-
-def filter_missing_avatars(chars: Dict[str, 'ArknightsCharacter'], available: Dict[str, set]) -> int:
-    """Drop avatars whose png does not exist in ArknightsGameResource.
-
-    Operator/token/trap avatars must exist in avatar/, enemy avatars in enemy/.
-    Special chars (remote spec data) are left untouched.
-    """
-    dropped = 0
-    for char in chars.values():
-        if char.special:
-            continue
-        pool = available['enemy'] if char.is_enemy else available['avatar']
-        for avatar_id in list(char.avatars):
-            if avatar_id not in pool:
-                print(f'[FILTER] {char.id} drop avatar {avatar_id} (missing in ArknightsGameResource)')
-                del char.avatars[avatar_id]
-                dropped += 1
-    return dropped
-
-
-class ArknightsCharacter(Character):
-    def __init__(self, char_id: str, series: str, is_enemy: bool = False, /, special: bool = False):
-        super().__init__(char_id, series, special=special)
-        self.is_enemy: bool = is_enemy
-
-
-class ArknightsResource(Resource):
-    langs = [
-        'zh_CN',
-        'en_US',
-        'ja_JP',
-    ]
-    main_url = 'https://github.com/Kengxxiao/ArknightsGameData/raw/master/'
-    yostar_url = 'https://github.com/Kengxxiao/ArknightsGameData_YoStar/raw/main/'
-    char_data_url = '%s/gamedata/excel/character_table.json'
-    enemy_data_url = '%s/gamedata/excel/enemy_handbook_table.json'
-    char_skin_url = 'https://github.com/Kengxxiao/ArknightsGameData/raw/master/zh_CN/gamedata/excel/skin_table.json'
-    char_avatar_url = 'https://github.com/yuanyan3060/ArknightsGameResource/raw/main/avatar/%s.png'
-    enemy_avatar_url = 'https://github.com/yuanyan3060/ArknightsGameResource/raw/main/enemy/%s.png'
-    game_resource_api = 'https://api.github.com/repos/yuanyan3060/ArknightsGameResource'
-    avatar_tree_url = game_resource_api + '/git/trees/main:%s'
-    chars: Dict[str, ArknightsCharacter]
-    char_model = ArknightsCharacter
-
-    def data_url(self, lang: str, t: str):
-        if t == 'char':
-            url = self.char_data_url % lang
-        elif t == 'enemy':
-            url = self.enemy_data_url % lang
-        else:
-            raise ValueError('unknown data url type %s' % t)
-        if lang == 'zh_CN':
-            return self.main_url + url
-        else:
-            return self.yostar_url + url
-
-    async def parse(self, lang):
-        res: dict = await self.json(self.data_url(lang, 'char'), 'char_data')
-        print('get arknights %s char data' % lang)
-        for char_id, data in res.items():
-            char = self.char(char_id)
-            char.add_name(lang, data['name'])
-            if lang == 'zh_CN':
-                char.add_name('zh_TW', s2t(data['name']))
-                char.add_name('py', ''.join(lazy_pinyin(data['name'])))
-                char.add_name('fpy', ''.join(lazy_pinyin(data['name'], style=Style.FIRST_LETTER)))
-                if data['profession'] == 'TRAP':
-                    char.add_tag('trap')
-                elif data['profession'] == 'TOKEN':
-                    char.add_tag('token')
-                else:
-                    char.add_tag('operator')
-                if data['displayNumber']:
-                    char.add_name('code', data['displayNumber'])
-
-        res: dict = await self.json(self.data_url(lang, 'enemy'), 'enemy_data')
-        if 'enemyData' in res:
-            res = res['enemyData']
-
-        print('get arknights %s enemy data' % lang)
-        for enemy_id, data in res.items():
-            char = self.enemy(enemy_id)
-            char.add_name(lang, data['name'])
-
-            if lang == 'zh_CN':
-                char.add_name('py', ''.join(lazy_pinyin(data['name'])))
-                char.add_name('fpy', ''.join(lazy_pinyin(data['name'], style=Style.FIRST_LETTER)))
-                char.add_name('code', data['enemyIndex'])
-                char.add_name('zh_TW', s2t(data['name']))
-                char.add_avatar(enemy_id)
-                char.add_tag('enemy')
-
-    async def available_names(self, folder: str) -> set:
-        """List the png base names available in an ArknightsGameResource folder."""
-        error = None
-        for attempt in range(3):
-            try:
-                res: dict = await self.json(self.avatar_tree_url % folder, folder + '_tree')
-                if res.get('truncated'):
-                    raise AssertionError(f'get {self.series} {folder} tree truncated')
-                return available_avatar_names(res.get('tree') or [])
-            except (AssertionError, FileNotFoundError, ServerError, ValueError) as e:
-                error = e
-                if attempt < 2:
-                    print(f'retry get {self.series} {folder} tree (attempt {attempt + 1})')
-                    await asyncio.sleep(2 ** attempt)
-        raise error
-
-    async def fetch_available_avatars(self) -> Optional[Dict[str, set]]:
-        """Map 'avatar'/'enemy' to the png base names available in ArknightsGameResource.
-
-        Returns None (filtering is skipped for this run) when the listings cannot be fetched.
-        """
-        try:
-            avatar, enemy = await asyncio.gather(
-                self.available_names('avatar'),
-                self.available_names('enemy'),
-            )
-            return {'avatar': avatar, 'enemy': enemy}
-        except (AssertionError, FileNotFoundError, ServerError, ValueError) as e:
-            print(f'[WARNING] fetch available avatars failed {e}; skip pre-filter')
-            return None
-
-    async def run(self):
-        await super().run()
-        await asyncio.gather(*[self.parse(lang) for lang in self.langs])
-
-        skins = await self.json(self.char_skin_url, 'skin_data')
-        for data in skins['charSkins'].values():
-            self.char(data['charId']).add_avatar(data['avatarId'])
-
-        available = await self.fetch_available_avatars()
-        if available is not None:
-            filter_missing_avatars(self.chars, available)
-
-        await self.update()
-
-    def start(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.run())
-
-    def _char(self, char_id: str, is_enemy: bool, /, special: bool = False) -> ArknightsCharacter:
-        if char_id not in self.chars:
-            self.chars[char_id] = self.char_model(char_id, self.series, is_enemy, special=special)
-        return self.chars[char_id]
-
-    def char(self, char_id: str, /, special: bool = False) -> ArknightsCharacter:
-        return self._char(char_id, False, special=special)
-
-    def enemy(self, enemy_id: str) -> ArknightsCharacter:
-        return self._char(enemy_id, True)
-
-    async def get_avatar_data(self, char: ArknightsCharacter, avatar: str) -> bytes:
-        if char.is_enemy:
-            return await self.req(self.enemy_avatar_url % quote(avatar), 'enemy_avatar', True)
-        else:
-            return await self.req(self.char_avatar_url % quote(avatar), 'char_avatar', True)
-
-
-ArknightsResource = ArknightsResource('arknights')
+import json
+import asyncio
+import hashlib
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import quote
+
+from util import metrics
+from util.resource import Resource, Character, ServerError
+from util.names import NameCache
+from util.time import get_time
+
+
+def available_avatar_blobs(entries: list) -> Dict[str, str]:
+    """Map the base names of top-level .png blobs in a git tree listing to their blob sha."""
+    blobs = {}
+    for entry in entries or []:
+        if entry.get('type') != 'blob':
+            continue
+        path = entry.get('path')
+        if isinstance(path, str) and path.endswith('.png'):
+            blobs[path[:-4]] = entry.get('sha')
+    return blobs
+
+
+def available_avatar_names(entries: list) -> set:
+    """Extract the base names of top-level .png blobs from a git tree listing."""
+    return set(available_avatar_blobs(entries))
+
+
+def filter_missing_avatars(chars: Dict[str, 'ArknightsCharacter'], available: Dict[str, set]) -> int:
+    """Drop avatars whose png does not exist in ArknightsGameResource.
+
+    Operator/token/trap avatars must exist in avatar/, enemy avatars in enemy/.
+    Special chars (remote spec data) are left untouched.
+    """
+    dropped = 0
+    for char in chars.values():
+        if char.special:
+            continue
+        pool = available['enemy'] if char.is_enemy else available['avatar']
+        for avatar_id in list(char.avatars):
+            if avatar_id not in pool:
+                print(f'[FILTER] {char.id} drop avatar {avatar_id} (missing in ArknightsGameResource)')
+                char.remove_avatar(avatar_id)
+                dropped += 1
+    return dropped
+
+
+def char_fields(char_id: str, data) -> Optional[dict]:
+    """The character_table.json fields parse reads."""
+    if not isinstance(data, dict):
+        return None
+    return {'name': data['name'], 'profession': data['profession'], 'displayNumber': data['displayNumber']}
+
+
+def enemy_fields(enemy_id: str, data) -> Optional[dict]:
+    """The enemy_handbook_table.json fields parse reads, None for items that are not enemies."""
+    if not isinstance(data, dict) or 'enemyIndex' not in data:
+        return None
+    return {'name': data['name'], 'enemyIndex': data['enemyIndex']}
+
+
+class ArknightsCharacter(Character):
+    def __init__(self, char_id: str, series: str, is_enemy: bool = False, /, special: bool = False):
+        super().__init__(char_id, series, special=special)
+        self.is_enemy: bool = is_enemy
+
+
+class ArknightsResource(Resource):
+    langs = [
+        'zh_CN',
+        'en_US',
+        'ja_JP',
+    ]
+    main_url = 'https://github.com/Kengxxiao/ArknightsGameData/raw/master/'
+    yostar_url = 'https://github.com/Kengxxiao/ArknightsGameData_YoStar/raw/main/'
+    char_data_url = '%s/gamedata/excel/character_table.json'
+    enemy_data_url = '%s/gamedata/excel/enemy_handbook_table.json'
+    char_skin_url = 'https://github.com/Kengxxiao/ArknightsGameData/raw/master/zh_CN/gamedata/excel/skin_table.json'
+    char_avatar_url = 'https://github.com/yuanyan3060/ArknightsGameResource/raw/main/avatar/%s.png'
+    enemy_avatar_url = 'https://github.com/yuanyan3060/ArknightsGameResource/raw/main/enemy/%s.png'
+    game_resource_api = 'https://api.github.com/repos/yuanyan3060/ArknightsGameResource'
+    avatar_tree_url = game_resource_api + '/git/trees/main:%s'
+    source_commit_urls = {
+        'ArknightsGameData': 'https://api.github.com/repos/Kengxxiao/ArknightsGameData/commits/master',
+        'ArknightsGameData_YoStar': 'https://api.github.com/repos/Kengxxiao/ArknightsGameData_YoStar/commits/main',
+        'ArknightsGameResource': game_resource_api + '/commits/main',
+    }
+    source_state_path = Path('version/arknights.source.json')
+    chars: Dict[str, ArknightsCharacter]
+    char_model = ArknightsCharacter
+
+    def __init__(self, series: str):
+        super().__init__(series)
+        # folder -> avatar id -> git blob sha, filled by available_names
+        self.blobs: Dict[str, Dict[str, str]] = {}
+        self.names: NameCache = NameCache()
+
+    def data_url(self, lang: str, t: str):
+        if t == 'char':
+            url = self.char_data_url % lang
+        elif t == 'enemy':
+            url = self.enemy_data_url % lang
+        else:
+            raise ValueError('unknown data url type %s' % t)
+        if lang == 'zh_CN':
+            return self.main_url + url
+        else:
+            return self.yostar_url + url
+
+    async def parse(self, lang):
+        res: dict = await self.table(self.data_url(lang, 'char'), 'char_data', char_fields, cache=True)
+        print('get arknights %s char data' % lang)
+        derived = self.names.derive(data['name'] for data in res.values()) if lang == 'zh_CN' else {}
+        for char_id, data in res.items():
+            char = self.char(char_id)
+            char.add_name(lang, data['name'])
+            if lang == 'zh_CN':
+                zh_tw, py, fpy = derived[data['name']]
+                char.add_name('zh_TW', zh_tw)
+                char.add_name('py', py)
+                char.add_name('fpy', fpy)
+                if data['profession'] == 'TRAP':
+                    char.add_tag('trap')
+                elif data['profession'] == 'TOKEN':
+                    char.add_tag('token')
+                else:
+                    char.add_tag('operator')
+                if data['displayNumber']:
+                    char.add_name('code', data['displayNumber'])
+
+        res: dict = await self.table(self.data_url(lang, 'enemy'), 'enemy_data', enemy_fields,
+                                     descend=('enemyData',), cache=True)
+
+        print('get arknights %s enemy data' % lang)
+        derived = self.names.derive(data['name'] for data in res.values()) if lang == 'zh_CN' else {}
+        for enemy_id, data in res.items():
+            char = self.enemy(enemy_id)
+            char.add_name(lang, data['name'])
+
+            if lang == 'zh_CN':
+                zh_tw, py, fpy = derived[data['name']]
+                char.add_name('py', py)
+                char.add_name('fpy', fpy)
+                char.add_name('code', data['enemyIndex'])
+                char.add_name('zh_TW', zh_tw)
+                char.add_avatar(enemy_id)
+                char.add_tag('enemy')
+
+    async def available_names(self, folder: str) -> set:
+        """List the png base names available in an ArknightsGameResource folder."""
+        res: dict = await self.json(self.avatar_tree_url % folder, folder + '_tree', cache=True)
+        if res.get('truncated'):
+            raise AssertionError(f'get {self.series} {folder} tree truncated')
+        self.blobs[folder] = available_avatar_blobs(res.get('tree') or [])
+        return set(self.blobs[folder])
+
+    async def fetch_available_avatars(self) -> Optional[Dict[str, set]]:
+        """Map 'avatar'/'enemy' to the png base names available in ArknightsGameResource.
+
+        Returns None (filtering is skipped for this run) when the listings cannot be fetched.
+        """
+        try:
+            avatar, enemy = await asyncio.gather(
+                self.available_names('avatar'),
+                self.available_names('enemy'),
+            )
+            return {'avatar': avatar, 'enemy': enemy}
+        except (AssertionError, FileNotFoundError, ServerError, ValueError) as e:
+            print(f'[WARNING] fetch available avatars failed {e}; skip pre-filter')
+            return None
+
+    async def source_commits(self) -> Optional[Dict[str, str]]:
+        """Head commit sha of every upstream repository, None when any cannot be fetched."""
+        try:
+            shas = await asyncio.gather(*[
+                self.req(url, name + '_commit', headers={'Accept': 'application/vnd.github.sha'})
+                for name, url in self.source_commit_urls.items()
+            ])
+        except (AssertionError, FileNotFoundError, ServerError) as e:
+            print(f'[WARNING] get {self.series} source commits failed {e}')
+            return None
+        return {name: sha.strip() for name, sha in zip(self.source_commit_urls, shas)}
+
+    @property
+    def special_digest(self) -> str:
+        return hashlib.md5(''.join(
+            f'{char_id}:{digest}' for char_id, digest in self.digests.items() if self.chars[char_id].special
+        ).encode('utf-8')).hexdigest()
+
+    def load_source_state(self) -> Optional[dict]:
+        if not self.source_state_path.exists():
+            return None
+        try:
+            data = json.loads(self.source_state_path.read_text(encoding='utf-8'))
+        except json.JSONDecodeError:
+            print(f'[WARNING] invalid {self.series} source state {self.source_state_path}')
+            return None
+        return data if isinstance(data, dict) else None
+
+    def save_source_state(self, state: dict):
+        self.source_state_path.parent.mkdir(exist_ok=True)
+        self.source_state_path.write_text(json.dumps(state, indent=2) + '\n', encoding='utf-8')
+
+    def commit_source_state(self, state: dict):
+        self.save_source_state(state)
+        self.git.add(f'[Arknights UPDATE] Source:{get_time()}-{state["commits"]["ArknightsGameData"][:6]}',
+                     self.source_state_path.as_posix())
+
+    async def run(self):
+        with metrics.run(self.series):
+            await self._run()
+
+    async def _run(self):
+        with metrics.phase('special'):
+            await super().run()
+
+        with metrics.phase('source_commits'):
+            commits = await self.source_commits()
+            state = {'commits': commits, 'special': self.special_digest, 'version': await self.remote_version,
+                     # publishing state that update() catches up on even when upstream does not move
+                     'variants': self.variants_document, 'shards': self.load_shard_manifest() is not None}
+        if commits is not None and state == self.load_source_state():
+            print(f'pass {self.series} sources unchanged')
+            return
+
+        with metrics.phase('parse'):
+            await asyncio.gather(*[self.parse(lang) for lang in self.langs])
+            self.names.save()
+
+        with metrics.phase('skins'):
+            skins = await self.json(self.char_skin_url, 'skin_data', cache=True)
+            for data in skins['charSkins'].values():
+                self.char(data['charId']).add_avatar(data['avatarId'])
+
+        with metrics.phase('filter'):
+            available = await self.fetch_available_avatars()
+            if available is not None:
+                filter_missing_avatars(self.chars, available)
+
+        await self.update()
+
+        # a run that skipped avatars must be repeated even if upstream does not move
+        if commits is not None and available is not None and not self.failed:
+            state['version'] = self.version
+            state['shards'] = self.load_shard_manifest() is not None
+            if state != self.load_source_state():
+                self.commit_source_state(state)
+
+    def start(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.run())
+        finally:
+            loop.run_until_complete(self.fetch.close())
+            self.decoder.close()
+        self.git.commit()
+
+    def _char(self, char_id: str, is_enemy: bool, /, special: bool = False) -> ArknightsCharacter:
+        if char_id not in self.chars:
+            self.chars[char_id] = self.char_model(char_id, self.series, is_enemy, special=special)
+        return self.chars[char_id]
+
+    def char(self, char_id: str, /, special: bool = False) -> ArknightsCharacter:
+        return self._char(char_id, False, special=special)
+
+    def enemy(self, enemy_id: str) -> ArknightsCharacter:
+        return self._char(enemy_id, True)
+
+    def avatar_sha(self, char: ArknightsCharacter, avatar: str) -> Optional[str]:
+        return self.blobs.get('enemy' if char.is_enemy else 'avatar', {}).get(avatar)
+
+    async def get_avatar_data(self, char: ArknightsCharacter, avatar: str) -> bytes:
+        if char.is_enemy:
+            return await self.req(self.enemy_avatar_url % quote(avatar), 'enemy_avatar', True)
+        else:
+            return await self.req(self.char_avatar_url % quote(avatar), 'char_avatar', True)
+
+
+ArknightsResource = ArknightsResource('arknights')
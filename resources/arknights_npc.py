@@ -1,14 +1,15 @@
 import asyncio
 import json
-import os
-import subprocess
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
 from urllib.parse import quote
 
-import aiohttp
-
+from util import metrics
+from util.decode import decoder
+from util.fetch import Fetcher, fetcher
+from util.git import GitChanges, changes
+from util.ledger import UploadLedger, ledger
 from util.time import get_time
 from util.upload import Uploader
 
@@ -64,19 +65,21 @@ def changed_files(previous: dict[str, SourceFile], current: dict[str, SourceFile
 class ArknightsNPCSource:
     api_url = 'https://api.github.com/repos/Arkfans/ArknightsAvatarResource'
     raw_url = 'https://raw.githubusercontent.com/Arkfans/ArknightsAvatarResource/%s/%s'
+    series = 'arknights_npc'
     source_state_path = Path('version/arknights_npc.source.json')
     concurrency = 16
 
     def __init__(self):
-        self.client: aiohttp.ClientSession | None = None
+        self.fetch: Fetcher = fetcher
         self.upload: Uploader | None = None
+        self.ledger: UploadLedger | None = ledger
+        self.git: GitChanges = changes
 
     async def request(self, url: str, target: str, *, byte: bool = False) -> bytes | dict[str, Any]:
-        assert self.client is not None
-        async with self.client.get(url) as response:
-            if response.status != 200:
-                raise RuntimeError(f'get arknights npc {target} failed {url} {response.status}')
-            return await response.read() if byte else await response.json()
+        response = await self.fetch.get(url)
+        if response.status != 200:
+            raise RuntimeError(f'get arknights npc {target} failed {url} {response.status}')
+        return response.body if byte else await decoder.loads(response.body)
 
     async def commit(self, ref: str) -> tuple[str, str]:
         data = await self.request(f'{self.api_url}/commits/{quote(ref, safe="")}', 'commit')
@@ -121,24 +124,29 @@ class ArknightsNPCSource:
             source_url = self.raw_url % (commit_sha, quote(file.source_path, safe='/'))
             content = await self.request(source_url, file.source_path, byte=True)
             assert isinstance(content, bytes)
-            await self.upload(file.target_path, content)
+            result = await self.upload(file.target_path, content)
+            if not result:
+                raise RuntimeError(f'upload arknights npc {file.target_path} failed {result.error}')
             print(f'upload arknights npc {file.target_path}')
 
     def commit_state(self, commit_sha: str) -> None:
-        subprocess.run(['git', 'add', str(self.source_state_path)], check=True)
-        subprocess.run(
-            ['git', 'commit', '-m', f'[Arknights NPC UPDATE] Source:{get_time()}-{commit_sha[:6]}'],
-            check=True,
-        )
-        github_env = os.environ.get('GITHUB_ENV')
-        if github_env:
-            with open(github_env, mode='a', encoding='utf-8') as file:
-                file.write('update=1\n')
+        self.git.add(f'[Arknights NPC UPDATE] Source:{get_time()}-{commit_sha[:6]}', self.source_state_path.as_posix())
 
     async def run(self) -> None:
-        async with aiohttp.ClientSession() as client:
-            self.client = client
-            self.upload = Uploader(client)
+        # a runner may hand in an uploader shared by every series
+        own = self.upload is None
+        if own:
+            self.upload = Uploader(ledger=self.ledger)
+        try:
+            with metrics.run(self.series):
+                await self.sync()
+        finally:
+            if own:
+                await self.upload.close()
+                self.upload = None
+
+    async def sync(self) -> None:
+        with metrics.phase('tree'):
             current_commit, current_tree_sha = await self.commit('main')
             previous_commit = self.load_state()
 
@@ -148,23 +156,32 @@ class ArknightsNPCSource:
                 _, previous_tree_sha = await self.commit(previous_commit)
                 previous_files = await self.tree(previous_tree_sha)
 
-            updates = changed_files(previous_files, current_files)
-            if updates:
-                print(f'update arknights npc {current_commit} ({len(updates)} files)')
-                semaphore = asyncio.Semaphore(self.concurrency)
+        updates = changed_files(previous_files, current_files)
+        if updates:
+            print(f'update arknights npc {current_commit} ({len(updates)} files)')
+            semaphore = asyncio.Semaphore(self.concurrency)
+            with metrics.phase('upload'):
                 await asyncio.gather(*[
                     self.upload_file(current_commit, file, semaphore)
                     for file in updates
                 ])
-            else:
-                print(f'pass arknights npc {current_commit}')
+        else:
+            print(f'pass arknights npc {current_commit}')
+
+        if previous_commit != current_commit:
+            self.save_state(current_commit)
+            self.commit_state(current_commit)
 
-            if previous_commit != current_commit:
-                self.save_state(current_commit)
-                self.commit_state(current_commit)
+    async def main(self) -> None:
+        try:
+            await self.run()
+        finally:
+            await self.fetch.close()
+            decoder.close()
 
     def start(self) -> None:
-        asyncio.run(self.run())
+        asyncio.run(self.main())
+        self.git.commit()
 
 
 ArknightsNPCResource = ArknightsNPCSource()
@@ -0,0 +1,362 @@
+"""Offline benchmark of the Arknights updater.
+
+Serves synthetic game tables, tree listings and avatars from a local aiohttp
+stand-in for GitHub, and a local upload server in place of SERVER, then times
+each phase of a run at several dataset sizes and writes a json report.
+
+    python scripts/benchmark.py --sizes 300 3000 30000 100000 --output benchmark.json
+    python scripts/benchmark.py --baseline benchmark.json
+
+With --baseline the run exits 1 when a phase got slower than the tolerance.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import platform
+import tempfile
+from io import BytesIO
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import util.resource
+import util.upload
+import resources.arknights
+from util.cache import git_blob_sha
+from util.ledger import UploadLedger
+from resources.arknights import filter_missing_avatars
+
+# the module replaces the class with its instance
+ArknightsResource = type(resources.arknights.ArknightsResource)
+
+# common characters the synthetic zh_CN names are built from
+alphabet = '阿米娅凯尔希能天使德克萨斯陈银灰艾雅法拉伊芙利特星熊塞雷娅闪灵夜莺推进之王莫斯提马麦哲伦黑煌令夕年嵯峨'
+
+
+def cjk_name(i: int) -> str:
+    name = ''
+    i += len(alphabet)
+    while i:
+        i, r = divmod(i, len(alphabet))
+        name += alphabet[r]
+    return name
+
+
+@lru_cache(maxsize=None)
+def avatar_png(avatar_id: str) -> bytes:
+    color = tuple(hashlib.md5(avatar_id.encode('utf-8')).digest()[:4])
+    buffer = BytesIO()
+    Image.new('RGBA', (32, 32), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class Dataset:
+    """Synthetic upstream with size characters: operators, tokens, traps, enemies and skins."""
+
+    def __init__(self, size: int, real_avatars: bool):
+        self.size = size
+        self.real_avatars = real_avatars
+        chars = int(size * 0.7)
+        self.char_table = {'zh_CN': {}, 'en_US': {}, 'ja_JP': {}}
+        for i in range(chars):
+            char_id = f'char_{i:06d}_bench'
+            profession = 'TOKEN' if i % 10 == 0 else 'TRAP' if i % 20 == 1 else 'WARRIOR'
+            number = f'B{i:06d}' if profession == 'WARRIOR' else None
+            self.char_table['zh_CN'][char_id] = {
+                'name': cjk_name(i), 'profession': profession, 'displayNumber': number, 'description': 'x' * 64
+            }
+            # the global servers lag behind
+            if i % 5:
+                self.char_table['en_US'][char_id] = {
+                    'name': f'Operator {i}', 'profession': profession, 'displayNumber': number
+                }
+                self.char_table['ja_JP'][char_id] = {
+                    'name': f'オペレーター{i}', 'profession': profession, 'displayNumber': number
+                }
+        self.enemy_table = {'zh_CN': {}, 'en_US': {}, 'ja_JP': {}}
+        for i in range(size - chars):
+            enemy_id = f'enemy_{i:06d}_bench'
+            self.enemy_table['zh_CN'][enemy_id] = {'name': cjk_name(chars + i), 'enemyIndex': f'E{i:06d}'}
+            if i % 5:
+                self.enemy_table['en_US'][enemy_id] = {'name': f'Enemy {i}', 'enemyIndex': f'E{i:06d}'}
+                self.enemy_table['ja_JP'][enemy_id] = {'name': f'エネミー{i}', 'enemyIndex': f'E{i:06d}'}
+        self.skins = {'charSkins': {}}
+        for i, char_id in enumerate(self.char_table['zh_CN']):
+            self.skins['charSkins'][char_id] = {'charId': char_id, 'avatarId': char_id}
+            if i % 2 == 0:
+                self.skins['charSkins'][char_id + '@1'] = {'charId': char_id, 'avatarId': char_id + '_1'}
+        avatars = [skin['avatarId'] for skin in self.skins['charSkins'].values()]
+        # a few avatars are missing upstream, as they are after every game update
+        self.avatars = {
+            'avatar': [avatar for i, avatar in enumerate(avatars) if i % 50 != 7],
+            'enemy': [enemy for i, enemy in enumerate(self.enemy_table['zh_CN']) if i % 50 != 7],
+        }
+        self.bodies: Dict[str, bytes] = {}
+
+    def blob_sha(self, avatar_id: str) -> str:
+        if self.real_avatars:
+            return git_blob_sha(avatar_png(avatar_id))
+        return hashlib.sha1(avatar_id.encode('utf-8')).hexdigest()
+
+    def body(self, name: str) -> bytes:
+        if name not in self.bodies:
+            kind, _, lang = name.partition(':')
+            if kind == 'char':
+                data = self.char_table[lang]
+            elif kind == 'enemy':
+                data = {'levelInfoList': [], 'enemyData': self.enemy_table[lang]}
+            elif kind == 'skin':
+                data = self.skins
+            else:
+                data = {'sha': kind, 'truncated': False, 'tree': [
+                    {'path': avatar + '.png', 'type': 'blob', 'sha': self.blob_sha(avatar)}
+                    for avatar in self.avatars[lang]
+                ]}
+            self.bodies[name] = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        return self.bodies[name]
+
+
+class FakeServers:
+    """One aiohttp app standing in for GitHub raw/API, the static site and the upload endpoint."""
+
+    def __init__(self):
+        self.dataset: Optional[Dataset] = None
+        self.static: Dict[str, bytes] = {}
+        self.hits: Counter = Counter()
+        self.served: Counter = Counter()
+        self.uploaded: Counter = Counter()
+        self.server: Optional[TestServer] = None
+        self.url: str = ''
+
+    def reset(self, dataset: Dataset):
+        self.dataset = dataset
+        self.static = {'version/char/arknights.txt': b'', 'char/arknights.json': b'{}'}
+        self.hits.clear()
+        self.served.clear()
+        self.uploaded.clear()
+
+    def respond(self, request: web.Request, route: str, body: bytes) -> web.Response:
+        self.hits[route] += 1
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        self.served[route] += len(body)
+        return web.Response(body=body, headers={'ETag': etag})
+
+    async def table(self, request: web.Request):
+        kind = {'character_table.json': 'char', 'enemy_handbook_table.json': 'enemy'}[request.match_info['file']]
+        return self.respond(request, kind, self.dataset.body(f'{kind}:{request.match_info["lang"]}'))
+
+    async def skin(self, request: web.Request):
+        return self.respond(request, 'skin', self.dataset.body('skin'))
+
+    async def tree(self, request: web.Request):
+        folder = request.match_info['folder']
+        return self.respond(request, 'tree', self.dataset.body(f'tree:{folder}'))
+
+    async def commit(self, request: web.Request):
+        self.hits['commit'] += 1
+        return web.Response(text=hashlib.sha1(request.match_info['name'].encode('utf-8')).hexdigest())
+
+    async def avatar(self, request: web.Request):
+        return self.respond(request, 'avatar', avatar_png(request.match_info['id']))
+
+    async def get_static(self, request: web.Request):
+        path = request.match_info['path']
+        self.hits['static'] += 1
+        if path not in self.static:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.static[path])
+
+    async def upload(self, request: web.Request):
+        form = await request.post()
+        file = form['file']
+        body = file.file.read() if hasattr(file, 'file') else bytes(file)
+        path = request.query['path']
+        self.static[path] = body
+        self.uploaded['files'] += 1
+        self.uploaded['bytes'] += len(body)
+        return web.json_response({'code': 200})
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get('/data/{repo}/{lang}/gamedata/excel/{file}', self.table)
+        app.router.add_get('/skin_table.json', self.skin)
+        app.router.add_get('/api/trees/{folder}', self.tree)
+        app.router.add_get('/api/commits/{name}', self.commit)
+        app.router.add_get('/avatar/{folder}/{id}.png', self.avatar)
+        app.router.add_get('/static/{path:.+}', self.get_static)
+        app.router.add_put('/upload', self.upload)
+        self.server = TestServer(app)
+        await self.server.start_server(access_log=None)
+        self.url = str(self.server.make_url('')).rstrip('/')
+
+    async def close(self):
+        await self.server.close()
+
+
+def make_resource(url: str) -> 'ArknightsResource':
+    """An ArknightsResource pointing at the fake servers, not touching git."""
+    resource = ArknightsResource('arknights')
+    resource.main_url = url + '/data/main/'
+    resource.yostar_url = url + '/data/yostar/'
+    resource.char_skin_url = url + '/skin_table.json'
+    resource.char_avatar_url = url + '/avatar/avatar/%s.png'
+    resource.enemy_avatar_url = url + '/avatar/enemy/%s.png'
+    resource.avatar_tree_url = url + '/api/trees/%s'
+    resource.source_commit_urls = {name: f'{url}/api/commits/{name}' for name in resource.source_commit_urls}
+    resource.ledger = UploadLedger(server=util.upload.server)
+    resource.commit = lambda version: None
+    return resource
+
+
+class Timer:
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def __call__(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.timings[name] = round(time.perf_counter() - start, 4)
+        print(f'  {name:<16} {self.timings[name]:>9.3f}s')
+
+
+async def bench(servers: FakeServers, size: int, update: bool) -> dict:
+    dataset = Dataset(size, real_avatars=update)
+    servers.reset(dataset)
+    timer = Timer()
+    print(f'{size} chars')
+
+    resource = make_resource(servers.url)
+    with timer('parse'):
+        await asyncio.gather(*[resource.parse(lang) for lang in resource.langs])
+        resource.names.save()
+    with timer('skins'):
+        skins = await resource.json(resource.char_skin_url, 'skin_data', cache=True)
+        for data in skins['charSkins'].values():
+            resource.char(data['charId']).add_avatar(data['avatarId'])
+    with timer('avatar_listing'):
+        available = await resource.fetch_available_avatars()
+    with timer('filter'):
+        dropped = filter_missing_avatars(resource.chars, available)
+    with timer('version'):
+        version = resource.version
+    with timer('version_warm'):
+        assert resource.version == version
+    with timer('data'):
+        data = resource.data
+    with timer('data_json'):
+        json.dumps(data, ensure_ascii=False)
+
+    # http validators, parsed selections and derived names are all cached by now
+    warm = make_resource(servers.url)
+    with timer('parse_warm'):
+        await asyncio.gather(*[warm.parse(lang) for lang in warm.langs])
+
+    if update:
+        with timer('update'):
+            await resource.update()
+        uploads = dict(servers.uploaded)
+        # nothing changed upstream, the second update only compares versions and manifests
+        with timer('update_noop'):
+            await resource.update()
+    else:
+        uploads = {}
+
+    return {
+        'size': size,
+        'chars': len(resource.chars),
+        'avatars': sum(len(char.avatars) for char in resource.chars.values()),
+        'dropped': dropped,
+        'timings': timer.timings,
+        'requests': dict(servers.hits),
+        'served_bytes': dict(servers.served),
+        'uploads': uploads,
+    }
+
+
+async def run(sizes: List[int], update_max: int) -> List[dict]:
+    servers = FakeServers()
+    await servers.start()
+    util.resource.static_url = servers.url + '/static/'
+    util.upload.server = servers.url + '/upload'
+    util.upload.key = 'benchmark'
+    cwd = os.getcwd()
+    results = []
+    try:
+        for size in sizes:
+            # caches, data/ and version/ of each size live in a scratch directory
+            with tempfile.TemporaryDirectory() as directory:
+                os.chdir(directory)
+                try:
+                    results.append(await bench(servers, size, size <= update_max))
+                finally:
+                    os.chdir(cwd)
+    finally:
+        await util.resource.fetcher.close()
+        await servers.close()
+    return results
+
+
+def compare(results: List[dict], baseline: dict, tolerance: float) -> List[str]:
+    """Phases slower than baseline by more than tolerance, ignoring ones under 10ms."""
+    previous = {result['size']: result['timings'] for result in baseline['results']}
+    regressions = []
+    for result in results:
+        for phase, seconds in result['timings'].items():
+            before = previous.get(result['size'], {}).get(phase)
+            if before is not None and seconds > 0.01 and seconds > before * (1 + tolerance):
+                regressions.append(f'{result["size"]} {phase} {before:.3f}s -> {seconds:.3f}s')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[300, 3000, 30000, 100000])
+    parser.add_argument('--update-max', type=int, default=10000,
+                        help='largest size update() is run for, it encodes and uploads every avatar')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='report of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, mode='rt', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = asyncio.run(run(args.sizes, args.update_max))
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    with open(args.output, mode='wt', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'report {args.output}')
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'[REGRESSION] {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,59 +1,290 @@
-import os
-import json
-import asyncio
-from pathlib import Path
-
-import yaml
-import uvicorn
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-
-
-class Config:
-    class Server:
-        def __init__(self, data: dict):
-            self.host: str = data.get('host', '127.0.0.1')
-            self.port: int = data.get('port', 33943)
-
-    def __init__(self, data: dict):
-        self.server: Config.Server = Config.Server(data.get('server', {}))
-
-
-if os.path.exists('config.yaml'):
-    with open('config.yaml', mode='rt', encoding='utf-8') as f:
-        config: Config = Config(yaml.safe_load(f) or {})
-else:
-    config: Config = Config({})
-
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=['*'],
-    allow_methods=['*'],
-    allow_headers=['*'],
-    allow_credentials=True
-)
-server = uvicorn.Server(uvicorn.Config(
-    app,
-    host=config.server.host,
-    port=config.server.port
-))
-
-base_dir = Path('../')
-
-
-@app.get('/char/{series}.json')
-async def get_character(series: str):
-    with (base_dir / 'data' / series).with_suffix('.json').open(mode='rt', encoding='utf-8') as f:
-        return json.load(f)
-
-
-@app.get('/version/char/{series}.txt')
-async def get_version(series: str):
-    return (base_dir / 'version' / series).with_suffix('.txt').read_text(encoding='utf-8')
-
-
-if __name__ == '__main__':
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(server.serve())
+import os
+import re
+import sys
+import gzip
+import json
+import hashlib
+import asyncio
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+import uvicorn
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse
+from fastapi.middleware.cors import CORSMiddleware
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from util.patch import diff_data
+from util.search import SearchIndex
+
+
+class Config:
+    class Server:
+        def __init__(self, data: dict):
+            self.host: str = data.get('host', '127.0.0.1')
+            self.port: int = data.get('port', 33943)
+            self.cache_control: str = data.get('cache_control', 'public, no-cache')
+            # cache: serve from memory with precompressed bodies, static: stream files from disk
+            self.mode: str = data.get('mode', 'cache')
+
+    def __init__(self, data: dict):
+        self.server: Config.Server = Config.Server(data.get('server', {}))
+
+
+if os.path.exists('config.yaml'):
+    with open('config.yaml', mode='rt', encoding='utf-8') as f:
+        config: Config = Config(yaml.safe_load(f) or {})
+else:
+    config: Config = Config({})
+
+app = FastAPI()
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=['*'],
+    allow_methods=['*'],
+    allow_headers=['*'],
+    allow_credentials=True
+)
+server = uvicorn.Server(uvicorn.Config(
+    app,
+    host=config.server.host,
+    port=config.server.port
+))
+
+base_dir = Path('../')
+series_pattern = re.compile(r'[A-Za-z0-9_\-]+')
+
+
+def series_path(folder: str, series: str, suffix: str) -> Path:
+    """Path of a series file under base_dir, 404 for invalid names or missing files."""
+    if not series_pattern.fullmatch(series):
+        raise HTTPException(404)
+    root = (base_dir / folder).resolve()
+    path = (root / (series + suffix)).resolve()
+    if path.parent != root or not path.is_file():
+        raise HTTPException(404)
+    return path
+
+
+def accepted_encodings(header: str) -> Dict[str, float]:
+    """Coding -> q-value of an Accept-Encoding header."""
+    codings = {}
+    for part in header.split(','):
+        coding, *params = (item.strip() for item in part.split(';'))
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding.lower()] = q
+    return codings
+
+
+class Body:
+    """A json response encoded once, with its precompressed variants and strong ETag.
+
+    Without an etag the md5 of the body is used. Bodies shorter than min_size are
+    not compressed, a few hundred bytes gain nothing from it. Compressed bodies
+    carry the etag with a -gz or -br suffix, a strong validator differs per
+    content-coding, and any of them validates the body.
+    """
+
+    suffixes = {'gzip': '-gz', 'br': '-br'}
+
+    def __init__(self, data, etag: Optional[str] = None, min_size: int = 0):
+        self.raw: bytes = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.etag: str = f'"{etag or hashlib.md5(self.raw).hexdigest()}"'
+        compress = len(self.raw) >= min_size
+        self.gzip: Optional[bytes] = gzip.compress(self.raw, 9) if compress else None
+        self.br: Optional[bytes] = brotli.compress(self.raw) if brotli is not None and compress else None
+
+    def tagged(self, encoding: Optional[str]) -> str:
+        return self.etag if encoding is None else f'{self.etag[:-1]}{self.suffixes[encoding]}"'
+
+    def response(self, request: Request) -> Response:
+        accepted = accepted_encodings(request.headers.get('accept-encoding', ''))
+        # highest q-value wins, br on a tie; q=0 refuses a coding
+        body, encoding, best = self.raw, None, 0.0
+        for coding, compressed in (('br', self.br), ('gzip', self.gzip)):
+            q = accepted.get(coding, accepted.get('*', 0.0))
+            if compressed is not None and q > best:
+                body, encoding, best = compressed, coding, q
+        headers = {'ETag': self.tagged(encoding), 'Cache-Control': config.server.cache_control,
+                   'Vary': 'Accept-Encoding'}
+
+        if_none_match = request.headers.get('if-none-match', '')
+        etags = {self.tagged(None), *(self.tagged(encoding) for encoding in self.suffixes)}
+        if not etags.isdisjoint(tag.strip() for tag in if_none_match.split(',')) or if_none_match.strip() == '*':
+            return Response(status_code=304, headers=headers)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        return Response(body, media_type='application/json', headers=headers)
+
+
+class SeriesData:
+    history_size = 8
+    batch_size = 256
+    # batch bodies kept per version, compressing one costs far more than a lookup
+    batch_cache = 64
+    # entry and batch bodies below this are sent uncompressed
+    small_body = 1024
+
+    def __init__(self, series: str):
+        self.series: str = series
+        self.version: Optional[str] = None
+        self.mtime: Optional[int] = None
+        self.data: Optional[dict] = None
+        self.body: Optional[Body] = None
+        # recent versions, oldest first
+        self.history: OrderedDict[str, dict] = OrderedDict()
+        # since version -> patch to the current version
+        self.patches: Dict[str, Body] = {}
+        self._index: Optional[SearchIndex] = None
+        # char id -> its entry, encoded on first request of a version
+        self.entries: Dict[str, Body] = {}
+        # sorted ids found -> their batch, least recently used first
+        self.batches: OrderedDict[Tuple[str, ...], Body] = OrderedDict()
+
+    @property
+    def data_path(self) -> Path:
+        return series_path('data', self.series, '.json')
+
+    @property
+    def version_path(self) -> Path:
+        return series_path('version', self.series, '.txt')
+
+    def load(self) -> 'SeriesData':
+        mtime = self.data_path.stat().st_mtime_ns
+        version = self.version_path.read_text(encoding='utf-8')
+        if version != self.version or mtime != self.mtime:
+            with self.data_path.open(mode='rt', encoding='utf-8') as f:
+                data = json.load(f)
+            if version != self.version:
+                self._index = None
+                self.entries.clear()
+                self.batches.clear()
+            self.version, self.mtime, self.data = version, mtime, data
+            self.body = Body(data, version)
+            self.history[version] = data
+            self.history.move_to_end(version)
+            while len(self.history) > self.history_size:
+                self.history.popitem(last=False)
+            self.patches.clear()
+        return self
+
+    @property
+    def index(self) -> SearchIndex:
+        # built on the first search of a version
+        if self._index is None:
+            self._index = SearchIndex(self.data)
+        return self._index
+
+    def entry(self, char_id: str) -> Optional[Body]:
+        """One char of the current version, None when it does not exist."""
+        if char_id not in self.data:
+            return None
+        if char_id not in self.entries:
+            self.entries[char_id] = Body(self.data[char_id], min_size=self.small_body)
+        return self.entries[char_id]
+
+    def batch(self, char_ids: List[str]) -> Body:
+        """Id -> entry of the requested chars that exist, ETag over exactly those entries.
+
+        The same set of ids gets the same body in any order, encoded once per version.
+        """
+        found = tuple(sorted({char_id for char_id in char_ids if char_id in self.data}))
+        body = self.batches.get(found)
+        if body is None:
+            etag = hashlib.md5(' '.join(self.entry(char_id).etag for char_id in found).encode('utf-8')).hexdigest()
+            body = self.batches[found] = Body({char_id: self.data[char_id] for char_id in found}, etag, self.small_body)
+            while len(self.batches) > self.batch_cache:
+                self.batches.popitem(last=False)
+        else:
+            self.batches.move_to_end(found)
+        return body
+
+    def patch(self, since: str) -> Optional[Body]:
+        """Changes from since to the current version, None when since is unknown."""
+        if since not in self.history:
+            return None
+        if since not in self.patches:
+            self.patches[since] = Body({'from': since, 'to': self.version,
+                                        **diff_data(self.history[since], self.data)}, f'{since}-{self.version}')
+        return self.patches[since]
+
+
+series_data: Dict[str, SeriesData] = {}
+
+
+def load_series(series: str) -> SeriesData:
+    # kept only once it loads, unknown names 404 without leaving an entry behind
+    data = series_data.get(series) or SeriesData(series)
+    series_data[series] = data.load()
+    return data
+
+
+@app.get('/char/{series}.json')
+async def get_character(series: str, request: Request, since: Optional[str] = None):
+    if config.server.mode == 'static' and since is None:
+        return FileResponse(series_path('data', series, '.json'), media_type='application/json',
+                            headers={'Cache-Control': config.server.cache_control})
+    data = load_series(series)
+    if since is not None:
+        patch = data.patch(since)
+        if patch is not None:
+            return patch.response(request)
+    return data.body.response(request)
+
+
+@app.get('/char/{series}/{char_id}')
+async def get_char(series: str, char_id: str, request: Request):
+    entry = load_series(series).entry(char_id)
+    if entry is None:
+        raise HTTPException(404)
+    return entry.response(request)
+
+
+@app.post('/char/{series}/batch')
+async def get_chars(series: str, request: Request):
+    try:
+        char_ids = await request.json()
+    except ValueError:
+        raise HTTPException(400, 'expect a json list of char ids')
+    if not isinstance(char_ids, list) or not all(isinstance(char_id, str) for char_id in char_ids):
+        raise HTTPException(400, 'expect a json list of char ids')
+    if len(char_ids) > SeriesData.batch_size:
+        raise HTTPException(413, f'at most {SeriesData.batch_size} ids per batch')
+    return load_series(series).batch(char_ids).response(request)
+
+
+@app.get('/version/char/{series}.txt')
+async def get_version(series: str):
+    # a json string in both modes, static mode only skips loading the data
+    if config.server.mode == 'static':
+        return series_path('version', series, '.txt').read_text(encoding='utf-8')
+    return load_series(series).version
+
+
+@app.get('/search/{series}')
+async def search(series: str, q: str, limit: int = Query(20, ge=1, le=100), tag: Optional[str] = None):
+    data = load_series(series)
+    return {'version': data.version, 'ids': data.index.search(q, limit, tag)}
+
+
+if __name__ == '__main__':
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(server.serve())
@@ -1,12 +1,19 @@
+import json
 import unittest
-from unittest.mock import AsyncMock, patch
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import AsyncMock, Mock, patch
 
+from util.resource import Resource
 from resources.arknights import (
     ArknightsCharacter,
     ArknightsResource,
+    available_avatar_blobs,
     available_avatar_names,
+    enemy_fields,
     filter_missing_avatars,
 )
+from util.stream import iter_object
 
 
 class AvailableAvatarNamesTests(unittest.TestCase):
@@ -28,6 +35,30 @@ class AvailableAvatarNamesTests(unittest.TestCase):
     def test_handles_empty_listing(self):
         self.assertEqual(available_avatar_names([]), set())
 
+    def test_keeps_blob_sha(self):
+        entries = [
+            {'path': 'char_002_amiya.png', 'type': 'blob', 'sha': 'a'},
+            {'path': 'char_002_amiya.webp', 'type': 'blob', 'sha': 'b'},
+        ]
+
+        self.assertEqual(available_avatar_blobs(entries), {'char_002_amiya': 'a'})
+
+
+class EnemyFieldsTests(unittest.TestCase):
+    def select(self, document: bytes) -> dict:
+        items = iter_object([document], ('enemyData',))
+        return {key: value for key, value in ((key, enemy_fields(key, value)) for key, value in items) if value}
+
+    def test_reads_wrapped_and_flat_tables(self):
+        enemy = {'name': '源石虫', 'enemyIndex': 'B1', 'description': '...', 'abilityList': []}
+        expected = {'enemy_1007_slime': {'name': '源石虫', 'enemyIndex': 'B1'}}
+
+        wrapped = {'levelInfoList': [], 'enemyData': {'enemy_1007_slime': enemy}, 'raceData': {}}
+        flat = {'enemy_1007_slime': enemy}
+
+        self.assertEqual(self.select(json.dumps(wrapped).encode()), expected)
+        self.assertEqual(self.select(json.dumps(flat).encode()), expected)
+
 
 class FilterMissingAvatarsTests(unittest.TestCase):
     def test_drops_unavailable_and_keeps_existing(self):
@@ -95,5 +126,66 @@ class ArknightsResourceFilterTests(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(names, {'char_002_amiya'})
 
 
+class ArknightsSourceStateTests(unittest.IsolatedAsyncioTestCase):
+    commits = {'ArknightsGameData': 'a', 'ArknightsGameData_YoStar': 'b', 'ArknightsGameResource': 'c'}
+
+    def make_resource(self, directory: str):
+        resource = type(ArknightsResource)('arknights')
+        resource.source_state_path = Path(directory) / 'arknights.source.json'
+        resource.source_commits = AsyncMock(return_value=dict(self.commits))
+        resource.req = AsyncMock(return_value='remote-version')
+        resource.parse = AsyncMock()
+        resource.commit_source_state = Mock()
+        resource.load_shard_manifest = Mock(return_value={'shards': {}})
+        return resource
+
+    def state(self, resource, **changes) -> dict:
+        return {
+            'commits': self.commits, 'special': resource.special_digest, 'version': 'remote-version',
+            'variants': resource.variants_document, 'shards': True, **changes
+        }
+
+    async def test_skips_run_when_sources_unchanged(self):
+        with TemporaryDirectory() as directory, patch.object(Resource, 'run', AsyncMock()), \
+                patch('util.metrics.metrics_dir', directory):
+            resource = self.make_resource(directory)
+            resource.save_source_state(self.state(resource))
+
+            await resource.run()
+
+        resource.parse.assert_not_awaited()
+
+    async def test_runs_when_publishing_state_is_behind(self):
+        for state in ({'shards': False}, {'variants': {'variants': []}}):
+            with self.subTest(state=state), TemporaryDirectory() as directory, \
+                    patch.object(Resource, 'run', AsyncMock()), patch('util.metrics.metrics_dir', directory):
+                resource = self.make_resource(directory)
+                resource.save_source_state(self.state(resource, **state))
+                resource.json = AsyncMock(return_value={'charSkins': {}})
+                resource.fetch_available_avatars = AsyncMock(return_value={'avatar': set(), 'enemy': set()})
+                resource.update = AsyncMock()
+
+                await resource.run()
+
+                resource.update.assert_awaited_once()
+
+    async def test_runs_and_records_state_when_sources_moved(self):
+        with TemporaryDirectory() as directory, patch.object(Resource, 'run', AsyncMock()), \
+                patch('util.metrics.metrics_dir', directory):
+            resource = self.make_resource(directory)
+            resource.save_source_state(self.state(resource, commits={**self.commits, 'ArknightsGameData': 'old'}))
+            resource.json = AsyncMock(return_value={'charSkins': {}})
+            resource.fetch_available_avatars = AsyncMock(return_value={'avatar': set(), 'enemy': set()})
+            resource.update = AsyncMock()
+
+            await resource.run()
+
+        self.assertEqual(resource.parse.await_count, len(resource.langs))
+        resource.update.assert_awaited_once()
+        state = resource.commit_source_state.call_args.args[0]
+        self.assertEqual(state['commits'], self.commits)
+        self.assertEqual(state['version'], resource.version)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
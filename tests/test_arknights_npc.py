@@ -1,7 +1,7 @@
 import unittest
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from unittest.mock import AsyncMock, Mock
+from unittest.mock import AsyncMock, Mock, patch
 
 from resources.arknights_npc import ArknightsNPCSource, build_source_files, changed_files
 
@@ -62,7 +62,7 @@ class ArknightsNPCSyncTests(unittest.IsolatedAsyncioTestCase):
         resource.upload_file = AsyncMock(side_effect=RuntimeError('upload failed'))
         resource.commit_state = Mock()
 
-        with TemporaryDirectory() as directory:
+        with TemporaryDirectory() as directory, patch('util.metrics.metrics_dir', directory):
             resource.source_state_path = Path(directory) / 'arknights_npc.source.json'
             with self.assertRaisesRegex(RuntimeError, 'upload failed'):
                 await resource.run()
@@ -0,0 +1,50 @@
+import json
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+from util.cache import BlobCache, ResponseCache, git_blob_sha
+
+
+class BlobCacheTests(unittest.TestCase):
+    def test_git_blob_sha_matches_git(self):
+        # git hash-object of a file containing 'hello\n'
+        self.assertEqual(git_blob_sha(b'hello\n'), 'ce013625030ba8dba906f756967f9e9ca394464a')
+
+    def test_evicts_least_recently_used(self):
+        with TemporaryDirectory() as directory:
+            cache = BlobCache(directory, max_size=8)
+            cache.put('aa11', 'png', b'1234')
+            cache.put('bb22', 'png', b'5678')
+            os.utime(cache.path('aa11', 'png'), (1, 1))
+            os.utime(cache.path('bb22', 'png'), (2, 2))
+            self.assertEqual(cache.get('aa11', 'png'), b'1234')
+
+            cache.put('cc33', 'webp', b'9012')
+
+            self.assertEqual(cache.get('aa11', 'png'), b'1234')
+            self.assertIsNone(cache.get('bb22', 'png'))
+            self.assertEqual(cache.get('cc33', 'webp'), b'9012')
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def test_results_are_stored_as_json_for_their_body(self):
+        with TemporaryDirectory() as directory:
+            cache = ResponseCache(directory)
+            url = 'https://example.com/table.json'
+            writer = cache.writer(url)
+            writer.write(b'{"a": 1}')
+            sha1 = writer.commit('"t1"', None)
+
+            cache.save_result(url, 'select', sha1, {'a': [1, '阿']})
+            path = cache.path(url, 'select.result.json')
+
+            self.assertEqual(json.loads(path.read_text(encoding='utf-8')), {'sha1': sha1, 'result': {'a': [1, '阿']}})
+            self.assertEqual(cache.load_result(url, 'select', sha1), {'a': [1, '阿']})
+            self.assertIsNone(cache.load_result(url, 'select', 'other'))
+            path.write_bytes(b'\x80\x04junk')
+            self.assertIsNone(cache.load_result(url, 'select', sha1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,21 @@
+import json
+import unittest
+
+from util.decode import JSONDecoder
+
+
+class JSONDecoderTests(unittest.IsolatedAsyncioTestCase):
+    async def test_decodes_small_inline_and_large_in_worker(self):
+        decoder = JSONDecoder(threshold=64, workers=1)
+        large = json.dumps({f'char_{i}': [i] for i in range(20)})
+        try:
+            self.assertEqual(await decoder.loads(b'{"a": 1}'), {'a': 1})
+            self.assertIsNone(decoder.executor)
+            self.assertEqual(await decoder.loads(large), json.loads(large))
+            self.assertIsNotNone(decoder.executor)
+        finally:
+            decoder.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
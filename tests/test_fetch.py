@@ -0,0 +1,83 @@
+import asyncio
+import time
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from util.fetch import Fetcher
+
+
+class FetcherTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.statuses = []
+        self.hits = 0
+        self.active = self.peak = 0
+
+        async def handle(request: web.Request):
+            self.hits += 1
+            await asyncio.sleep(0.01)
+            status, headers = self.statuses.pop(0) if self.statuses else (200, {})
+            return web.Response(status=status, body=b'body', headers=headers)
+
+        async def limited(request: web.Request):
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            await asyncio.sleep(0.02)
+            self.active -= 1
+            return web.Response(body=b'body')
+
+        app = web.Application()
+        app.router.add_get('/file', handle)
+        app.router.add_get('/limited', limited)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.url = str(self.server.make_url('/file'))
+        self.fetcher = Fetcher()
+        self.fetcher.backoff = 0
+
+    async def asyncTearDown(self):
+        await self.fetcher.close()
+        await self.server.close()
+
+    async def test_coalesces_identical_requests_in_flight(self):
+        responses = await asyncio.gather(*[self.fetcher.get(self.url) for _ in range(5)])
+        self.assertEqual([r.body for r in responses], [b'body'] * 5)
+        self.assertEqual(self.hits, 1)
+        await self.fetcher.get(self.url)
+        self.assertEqual(self.hits, 2)
+
+    async def test_retries_server_errors_and_returns_final_status(self):
+        self.statuses = [(502, {}), (503, {})]
+        self.assertEqual((await self.fetcher.get(self.url)).status, 200)
+        self.assertEqual(self.hits, 3)
+
+        self.statuses = [(500, {})] * 5
+        self.assertEqual((await self.fetcher.get(self.url)).status, 500)
+        self.assertEqual(self.hits, 3 + self.fetcher.retries + 1)
+
+        self.statuses = [(404, {})]
+        self.assertEqual((await self.fetcher.get(self.url)).status, 404)
+
+    async def test_waits_for_rate_limit_reset(self):
+        reset = str(int(time.time()))
+        self.statuses = [(403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': reset})]
+        async with self.fetcher.stream(self.url) as r:
+            self.assertEqual(r.status, 200)
+            self.assertEqual(await r.read(), b'body')
+        self.assertEqual(self.hits, 2)
+
+    async def test_gives_up_on_long_rate_limit(self):
+        self.fetcher.max_rate_wait = 1
+        self.statuses = [(429, {'Retry-After': '60'})]
+        self.assertEqual((await self.fetcher.get(self.url)).status, 429)
+        self.assertEqual(self.hits, 1)
+
+    async def test_limits_concurrency_per_host(self):
+        self.fetcher.default_limit = 2
+        await asyncio.gather(*[self.fetcher.get(str(self.server.make_url(f'/limited?i={i}'))) for i in range(6)])
+        self.assertEqual(self.peak, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+from io import BytesIO
+
+from PIL import Image
+
+from util.image import ImageEncoder, ImageError, Variant
+
+
+class ImageEncoderTests(unittest.IsolatedAsyncioTestCase):
+    async def test_returns_png_and_webp_bytes(self):
+        png = BytesIO()
+        Image.new('RGBA', (4, 4), (255, 0, 0, 255)).save(png, 'png')
+        encoder = ImageEncoder(1)
+        try:
+            original, webp, variants = await encoder(png.getvalue())
+        finally:
+            encoder.close()
+
+        self.assertEqual(original, png.getvalue())
+        self.assertEqual(Image.open(BytesIO(webp)).format, 'WEBP')
+        self.assertEqual(variants, {})
+
+    async def test_downscales_variants_without_upscaling(self):
+        png = BytesIO()
+        Image.new('RGBA', (180, 120), (255, 0, 0, 255)).save(png, 'png')
+        encoder = ImageEncoder(1, [Variant(48), Variant(96, lossless=True), Variant(256)])
+        try:
+            _, webp, variants = await encoder(png.getvalue())
+        finally:
+            encoder.close()
+
+        self.assertEqual({variant.size: Image.open(BytesIO(byte)).size for variant, byte in variants.items()},
+                         {48: (48, 32), 96: (96, 64), 256: (180, 120)})
+        self.assertEqual(Image.open(BytesIO(webp)).size, (180, 120))
+
+    async def test_broken_image_raises_image_error(self):
+        png = BytesIO()
+        Image.new('RGBA', (64, 64), (255, 0, 0, 255)).save(png, 'png')
+        encoder = ImageEncoder(1, [Variant(48)])
+        try:
+            for byte in (b'not an image', png.getvalue()[:-40]):
+                with self.subTest(size=len(byte)), self.assertRaises(ImageError):
+                    await encoder(byte)
+        finally:
+            encoder.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import asyncio
+import json
+import os
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from util import metrics
+
+
+class MetricsTests(unittest.IsolatedAsyncioTestCase):
+    async def test_writes_json_and_prometheus_summary(self):
+        async def download():
+            metrics.request('https://github.com/a.json', bytes_in=100)
+
+        with TemporaryDirectory() as directory, patch('util.metrics.trace_memory', True):
+            with metrics.run('test', directory):
+                with metrics.phase('parse'):
+                    # tasks started inside the run report to it
+                    await asyncio.gather(download(), download())
+                    data = bytearray(1 << 20)
+                    del data
+                with metrics.phase('upload'):
+                    metrics.request('https://upload.example/api', bytes_out=10)
+                    metrics.count('encodes', 3)
+            # outside of a run nothing is recorded
+            metrics.request('https://github.com/b.json', bytes_in=100)
+
+            summary = json.loads(Path(directory, 'test.json').read_text(encoding='utf-8'))
+            prometheus = Path(directory, 'test.prom').read_text(encoding='utf-8')
+
+        self.assertEqual(set(summary['phases']), {'total', 'parse', 'upload'})
+        self.assertEqual(summary['hosts']['github.com'], {'requests': 2, 'bytes_in': 200, 'bytes_out': 0})
+        self.assertEqual(summary['hosts']['upload.example']['bytes_out'], 10)
+        self.assertEqual(summary['counters'], {'encodes': 3})
+        self.assertGreaterEqual(summary['memory_peak']['parse'], 1 << 20)
+        self.assertLess(summary['memory_peak']['upload'], 1 << 20)
+        self.assertGreater(summary['max_rss'], 1 << 20)
+        self.assertIn('mayertalk_http_requests{run="test",host="github.com"} 2', prometheus)
+        self.assertIn('# TYPE mayertalk_phase_seconds gauge', prometheus)
+
+    def test_memory_tracing_is_opt_in(self):
+        with TemporaryDirectory() as directory:
+            with metrics.run('test', directory) as record:
+                with metrics.phase('parse'):
+                    pass
+
+        self.assertEqual(record.memory, {})
+        self.assertGreater(record.max_rss, 0)
+
+    def test_profiles_selected_phase(self):
+        with TemporaryDirectory() as directory, patch('util.metrics.profile_phase', 'parse'), \
+                patch('util.metrics.metrics_dir', directory):
+            with metrics.run('test'):
+                with metrics.phase('parse'):
+                    sum(range(1000))
+                with metrics.phase('upload'):
+                    pass
+            self.assertEqual(sorted(os.listdir(directory)), ['test.json', 'test.parse.prof', 'test.prom'])
+
+    async def test_profiles_one_of_concurrent_runs(self):
+        async def series(name: str):
+            with metrics.run(name):
+                with metrics.phase('parse'):
+                    await asyncio.sleep(0.01)
+
+        with TemporaryDirectory() as directory, patch('util.metrics.profile_phase', 'parse'), \
+                patch('util.metrics.metrics_dir', directory):
+            await asyncio.gather(series('a'), series('b'))
+            profiles = [name for name in os.listdir(directory) if name.endswith('.prof')]
+
+        self.assertEqual(profiles, ['a.parse.prof'])
+        self.assertFalse(metrics.profiling)
+
+
+if __name__ == '__main__':
+    unittest.main()
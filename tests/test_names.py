@@ -0,0 +1,31 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from util.cc import s2t
+from util.names import NameCache
+
+
+class NameCacheTests(unittest.TestCase):
+    def test_converts_only_new_names_in_one_batch(self):
+        with TemporaryDirectory() as directory, patch.object(s2t, 'batch', wraps=s2t.batch) as batch:
+            path = os.path.join(directory, 'names.json')
+            names = NameCache(path)
+            derived = names.derive(['阿米娅', '源石虫', '阿米娅'])
+            names.save()
+
+            self.assertEqual(derived['阿米娅'], ['阿米婭', 'amiya', 'amy'])
+            self.assertEqual(derived['源石虫'], ['源石蟲', 'yuanshichong', 'ysc'])
+            batch.assert_called_once_with(['阿米娅', '源石虫'])
+
+            names = NameCache(path)
+            derived = names.derive(['阿米娅', '凯尔希'])
+
+            self.assertEqual(derived['凯尔希'], ['凱爾希', 'kaierxi', 'kex'])
+            batch.assert_called_with(['凯尔希'])
+            self.assertEqual(batch.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
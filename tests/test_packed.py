@@ -0,0 +1,33 @@
+import unittest
+
+from util.packed import pack, unpack
+
+
+class PackedTests(unittest.TestCase):
+    def test_round_trip(self):
+        data = {
+            'char_002_amiya': [['阿米娅', '阿米婭', 'amiya', 'amy', 'Amiya', 'アーミヤ', 'R001'],
+                               ['', '_2', 'id:char_1001_amiya2_2'], ['operator']],
+            'enemy_1000_gopro': [['源石虫', 0, 'yuanshichong', 'ysc', 0, 0, 'B1'], [''], ['enemy']],
+            'doctor': [['博士'] + [0] * 6, ['id:https://example.com/a.png'], []],
+        }
+
+        packed = pack(data, 'v1')
+
+        self.assertEqual(unpack(packed), ('v1', data))
+
+    def test_interns_repeated_strings(self):
+        data = {f'char_{i}': [[f'name{i}'] + [0] * 6, ['', '_2'], ['operator']] for i in range(100)}
+
+        packed = pack(data, 'v1')
+
+        self.assertEqual(packed.count(b'operator'), 1)
+        self.assertEqual(unpack(packed)[1], data)
+
+    def test_rejects_other_documents(self):
+        with self.assertRaises(ValueError):
+            unpack(b'{"a": 1}')
+
+
+if __name__ == '__main__':
+    unittest.main()
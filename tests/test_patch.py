@@ -0,0 +1,27 @@
+import unittest
+
+from util.patch import apply_patch, diff_data, patch_chain
+
+
+class PatchTests(unittest.TestCase):
+    def test_diff_and_apply_round_trip(self):
+        old = {'a': [['A'], [''], ['operator']], 'b': [['B'], [''], ['enemy']], 'c': [['C'], [''], []]}
+        new = {'a': [['A'], ['', '_2'], ['operator']], 'c': [['C'], [''], []], 'd': [['D'], [''], ['token']]}
+
+        patch = diff_data(old, new)
+
+        self.assertEqual(patch['added'], {'d': new['d']})
+        self.assertEqual(patch['changed'], {'a': new['a']})
+        self.assertEqual(patch['removed'], ['b'])
+        self.assertEqual(apply_patch(old, patch), new)
+
+    def test_patch_chain_starts_at_client_version(self):
+        index = {'version': 'v3', 'patches': [{'from': 'v1', 'to': 'v2'}, {'from': 'v2', 'to': 'v3'}]}
+
+        self.assertEqual([patch['to'] for patch in patch_chain(index, 'v1')], ['v2', 'v3'])
+        self.assertEqual([patch['to'] for patch in patch_chain(index, 'v2')], ['v3'])
+        self.assertEqual(patch_chain(index, 'v0'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,415 @@
+import asyncio
+import json
+import os
+import unittest
+from tempfile import TemporaryDirectory
+from unittest.mock import AsyncMock, MagicMock, PropertyMock, patch
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from util.cache import BlobCache, ResponseCache, git_blob_sha
+from util.decode import JSONDecoder
+from util.fetch import Fetcher
+from util.image import ImageError, Variant
+from util.resource import Resource
+
+
+def make_resource() -> Resource:
+    resource = Resource('test')
+    amiya = resource.char('char_002_amiya')
+    amiya.add_name('zh_CN', '阿米娅')
+    amiya.add_avatar('char_002_amiya')
+    amiya.add_avatar('char_002_amiya_2')
+    kalts = resource.char('char_003_kalts')
+    kalts.add_name('zh_CN', '凯尔希')
+    kalts.add_avatar('char_003_kalts')
+    doctor = resource.char('doctor', special=True)
+    doctor.add_name('zh_CN', '博士')
+    doctor.add_avatar('doctor')
+    return resource
+
+
+class VersionTests(unittest.TestCase):
+    def test_digest_only_recomputed_after_change(self):
+        resource = make_resource()
+        amiya = resource.chars['char_002_amiya']
+        digest = amiya.digest
+
+        amiya.add_name('zh_CN', '阿米娅')
+        amiya.add_avatar('char_002_amiya')
+        self.assertIsNotNone(amiya._digest)
+        self.assertEqual(amiya.digest, digest)
+
+        amiya.add_tag('operator')
+        self.assertIsNone(amiya._digest)
+        self.assertNotEqual(amiya.digest, digest)
+
+    def test_changed_ids_since_snapshot(self):
+        resource = make_resource()
+        snapshot = resource.digests
+        version = resource.version
+
+        resource.chars['char_003_kalts'].remove_avatar('char_003_kalts')
+        resource.char('char_010_chen').add_name('zh_CN', '陈')
+        resource.chars.pop('doctor')
+
+        self.assertEqual(resource.changed(snapshot), {'char_003_kalts', 'char_010_chen', 'doctor'})
+        self.assertNotEqual(resource.version, version)
+
+
+class PendingAvatarsTests(unittest.TestCase):
+    def test_selects_avatars_missing_on_remote(self):
+        resource = make_resource()
+        remote_data = {'char_002_amiya': {'names': {}, 'avatars': [''], 'tags': []}}
+
+        pending = resource.pending_avatars(remote_data)
+
+        self.assertEqual(
+            [(char.id, avatar) for char, avatar in pending],
+            [('char_002_amiya', 'char_002_amiya_2'), ('char_003_kalts', 'char_003_kalts')],
+        )
+
+    def test_selects_changed_images_from_manifest(self):
+        resource = make_resource()
+        shas = {'char_002_amiya': 'new', 'char_002_amiya_2': 'same', 'char_003_kalts': 'kalts'}
+        resource.avatar_sha = lambda char, avatar: shas.get(avatar)
+        manifest = {'char_002_amiya': 'old', 'char_002_amiya_2': 'same'}
+
+        pending = resource.pending_avatars(None, manifest)
+
+        self.assertEqual(
+            [(char.id, avatar) for char, avatar in pending],
+            [('char_002_amiya', 'char_002_amiya'), ('char_003_kalts', 'char_003_kalts')],
+        )
+
+    def test_without_manifest_trusts_remote_images(self):
+        resource = make_resource()
+        resource.avatar_sha = lambda char, avatar: 'sha'
+
+        self.assertEqual(resource.pending_avatars(None), [])
+        self.assertEqual(
+            resource.avatar_manifest(None, []),
+            {'char_002_amiya': 'sha', 'char_002_amiya_2': 'sha', 'char_003_kalts': 'sha'},
+        )
+
+    def test_manifest_keeps_previous_sha_of_pending_and_unknown_avatars(self):
+        resource = make_resource()
+        shas = {'char_002_amiya': 'new', 'char_003_kalts': 'kalts'}
+        resource.avatar_sha = lambda char, avatar: shas.get(avatar)
+        amiya = resource.chars['char_002_amiya']
+        previous = {'char_002_amiya': 'old', 'char_002_amiya_2': 'same'}
+
+        manifest = resource.avatar_manifest(previous, [(amiya, 'char_002_amiya')])
+
+        self.assertEqual(manifest, {'char_002_amiya': 'old', 'char_002_amiya_2': 'same', 'char_003_kalts': 'kalts'})
+
+
+class UploadAvatarsTests(unittest.IsolatedAsyncioTestCase):
+    async def test_bounds_concurrency_and_drops_missing_after_completion(self):
+        resource = make_resource()
+        resource.concurrency = 2
+        running = 0
+        peak = 0
+
+        async def upload_avatar(char, avatar, semaphore):
+            nonlocal running, peak
+            async with semaphore:
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0)
+                running -= 1
+                # avatars must not change while other uploads are in flight
+                self.assertEqual(len(resource.chars['char_002_amiya'].avatars), 2)
+                return avatar != 'char_002_amiya_2'
+
+        resource.upload_avatar = AsyncMock(side_effect=upload_avatar)
+        pending = resource.pending_avatars({})
+
+        dropped = await resource.upload_avatars(pending)
+
+        self.assertEqual(dropped, 1)
+        self.assertLessEqual(peak, 2)
+        self.assertEqual(set(resource.chars['char_002_amiya'].avatars), {'char_002_amiya'})
+
+    async def test_unexpected_error_fails_only_its_avatar(self):
+        resource = make_resource()
+        resource.upload = AsyncMock(return_value=True)
+
+        async def avatar_bytes(char, avatar):
+            if avatar == 'char_002_amiya_2':
+                raise AssertionError('get test char_002_amiya_2 failed 403')
+            return b'png', b'webp', {}
+
+        resource.avatar_bytes = AsyncMock(side_effect=avatar_bytes)
+
+        dropped = await resource.upload_avatars(resource.pending_avatars({}))
+
+        self.assertEqual(dropped, 0)
+        self.assertEqual(resource.failed, 1)
+        self.assertEqual(resource.upload.await_count, 4)
+        self.assertEqual(set(resource.chars['char_002_amiya'].avatars), {'char_002_amiya', 'char_002_amiya_2'})
+
+    async def test_broken_image_is_dropped_like_a_missing_one(self):
+        resource = make_resource()
+        resource.upload = AsyncMock(return_value=True)
+        resource.avatar_bytes = AsyncMock(side_effect=ImageError('UnidentifiedImageError: cannot identify image file'))
+
+        dropped = await resource.upload_avatars([(resource.chars['char_003_kalts'], 'char_003_kalts')])
+
+        self.assertEqual(dropped, 1)
+        self.assertEqual(resource.failed, 0)
+        self.assertEqual(resource.chars['char_003_kalts'].avatars, {})
+
+    async def test_records_only_uploaded_avatars_in_manifest(self):
+        resource = make_resource()
+        resource.avatar_sha = lambda char, avatar: 'new-' + avatar
+        results = {'char_002_amiya': True, 'char_002_amiya_2': None, 'char_003_kalts': False}
+        resource.upload_avatar = AsyncMock(side_effect=lambda char, avatar, semaphore: results[avatar])
+        manifest = {'char_002_amiya': 'old', 'char_002_amiya_2': 'old', 'char_003_kalts': 'old'}
+
+        await resource.upload_avatars(resource.pending_avatars({}), manifest)
+
+        self.assertEqual(manifest, {'char_002_amiya': 'new-char_002_amiya', 'char_002_amiya_2': 'old'})
+
+
+class ResponseCacheTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.hits = []
+
+        async def table(request: web.Request):
+            self.hits.append(request.headers.get('If-None-Match'))
+            if request.headers.get('If-None-Match') == '"t1"':
+                return web.Response(status=304)
+            return web.Response(body=b'{"a": {"name": "A"}}', headers={'ETag': '"t1"'})
+
+        app = web.Application()
+        app.router.add_get('/table.json', table)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.directory = TemporaryDirectory()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+        self.directory.cleanup()
+
+    async def test_conditional_request_reuses_body_and_parsed_result(self):
+        url = str(self.server.make_url('/table.json'))
+        loads = []
+
+        async def run():
+            resource = Resource('test')
+            resource.responses = ResponseCache(self.directory.name)
+            resource.decoder = JSONDecoder()
+            resource.decoder.loads = AsyncMock(side_effect=lambda body: loads.append(body) or json.loads(body))
+            resource.fetch = Fetcher()
+            try:
+                return await resource.json(url, 'table', cache=True)
+            finally:
+                await resource.fetch.close()
+
+        first = await run()
+        second = await run()
+
+        self.assertEqual(first, {'a': {'name': 'A'}})
+        self.assertEqual(second, first)
+        self.assertEqual(self.hits, [None, '"t1"'])
+        self.assertEqual(len(loads), 1)
+
+    async def test_table_streams_selection_and_reuses_it(self):
+        url = str(self.server.make_url('/table.json'))
+        selected = []
+
+        def name_only(key, value):
+            selected.append(key)
+            return value['name']
+
+        async def run():
+            resource = Resource('test')
+            resource.responses = ResponseCache(self.directory.name)
+            resource.fetch = Fetcher()
+            try:
+                return await resource.table(url, 'table', name_only, cache=True)
+            finally:
+                await resource.fetch.close()
+
+        self.assertEqual(await run(), {'a': 'A'})
+        self.assertEqual(await run(), {'a': 'A'})
+        self.assertEqual(self.hits, [None, '"t1"'])
+        self.assertEqual(selected, ['a'])
+
+
+class AvatarBytesTests(unittest.IsolatedAsyncioTestCase):
+    async def test_cached_blob_skips_download_and_encode(self):
+        png = b'png-bytes'
+        sha = git_blob_sha(png)
+        resource = make_resource()
+        resource.avatar_sha = lambda char, avatar: sha
+        resource.get_avatar_data = AsyncMock(return_value=png)
+        resource.avatar_variants = (Variant(48),)
+        resource.encoder = AsyncMock(return_value=(png, b'webp-bytes', {Variant(48): b'48-bytes'}))
+        char = resource.chars['char_002_amiya']
+
+        with TemporaryDirectory() as directory:
+            resource.cache = BlobCache(directory)
+            first = await resource.avatar_bytes(char, 'char_002_amiya')
+            second = await resource.avatar_bytes(char, 'char_002_amiya')
+
+        self.assertEqual(first, (png, b'webp-bytes', {Variant(48): b'48-bytes'}))
+        self.assertEqual(second, first)
+        resource.get_avatar_data.assert_awaited_once()
+        resource.encoder.assert_awaited_once()
+
+    async def test_new_variant_settings_encode_again(self):
+        png = b'png-bytes'
+        sha = git_blob_sha(png)
+        resource = make_resource()
+        resource.avatar_sha = lambda char, avatar: sha
+        resource.get_avatar_data = AsyncMock(return_value=png)
+        char = resource.chars['char_002_amiya']
+
+        with TemporaryDirectory() as directory:
+            resource.cache = BlobCache(directory)
+            resource.avatar_variants = (Variant(48),)
+            resource.encoder = AsyncMock(return_value=(png, b'webp-bytes', {Variant(48): b'48-bytes'}))
+            await resource.avatar_bytes(char, 'char_002_amiya')
+            resource.avatar_variants = (Variant(48, quality=60),)
+            resource.encoder = AsyncMock(return_value=(png, b'webp-bytes', {Variant(48, quality=60): b'48q60'}))
+            _, _, variants = await resource.avatar_bytes(char, 'char_002_amiya')
+
+        self.assertEqual(variants, {Variant(48, quality=60): b'48q60'})
+        resource.get_avatar_data.assert_awaited_once()
+        resource.encoder.assert_awaited_once()
+
+    async def test_uploads_variants_next_to_avatar(self):
+        resource = make_resource()
+        resource.avatar_bytes = AsyncMock(return_value=(b'png', b'webp', {Variant(48): b'48', Variant(96): b'96'}))
+        resource.upload = AsyncMock(return_value=True)
+
+        ok = await resource.upload_avatar(resource.chars['char_002_amiya'], 'char_002_amiya', asyncio.Semaphore(1))
+
+        self.assertTrue(ok)
+        self.assertEqual([call.args for call in resource.upload.await_args_list], [
+            ('avatar/test/char_002_amiya.png', b'png'),
+            ('avatar/test/char_002_amiya.webp', b'webp'),
+            ('avatar/test/char_002_amiya@48.webp', b'48'),
+            ('avatar/test/char_002_amiya@96.webp', b'96'),
+        ])
+
+
+class UploadPatchTests(unittest.IsolatedAsyncioTestCase):
+    async def test_extends_index_and_keeps_recent_patches(self):
+        resource = Resource('test')
+        resource.patch_history = 2
+        resource.upload = AsyncMock()
+        resource.remote_patch_index = AsyncMock(return_value={
+            'version': 'v1', 'patches': [{'from': 'v0', 'to': 'v1', 'size': 1}]
+        })
+
+        await resource.upload_patch('v1', {'a': [['A'], [''], []]}, 'v2', {'b': [['B'], [''], []]})
+
+        (patch_path, patch_body), (index_path, index_body) = [call.args for call in resource.upload.await_args_list]
+        self.assertEqual(patch_path, 'char/test.patch/v1.json')
+        self.assertEqual(json.loads(patch_body)['removed'], ['a'])
+        self.assertEqual(index_path, 'char/test.patch.json')
+        index = json.loads(index_body)
+        self.assertEqual(index['version'], 'v2')
+        self.assertEqual([patch['from'] for patch in index['patches']], ['v0', 'v1'])
+
+    async def test_restarts_chain_when_index_is_behind(self):
+        resource = Resource('test')
+        resource.upload = AsyncMock()
+        resource.remote_patch_index = AsyncMock(return_value={
+            'version': 'v0', 'patches': [{'from': 'v-1', 'to': 'v0', 'size': 1}]
+        })
+
+        await resource.upload_patch('v1', {}, 'v2', {})
+
+        index = json.loads(resource.upload.await_args_list[-1].args[1])
+        self.assertEqual([patch['from'] for patch in index['patches']], ['v1'])
+
+
+class ShardTests(unittest.IsolatedAsyncioTestCase):
+    def make_resource(self) -> Resource:
+        resource = make_resource()
+        resource.char('char_002_amiya').add_tag('operator')
+        resource.char('char_003_kalts').add_tag('operator')
+        enemy = resource.char('enemy_1000_gopro')
+        enemy.add_name('zh_CN', '源石虫')
+        enemy.add_avatar('enemy_1000_gopro')
+        enemy.add_tag('enemy')
+        resource.upload = AsyncMock()
+        return resource
+
+    def test_splits_by_first_tag_and_special(self):
+        resource = self.make_resource()
+
+        shards = resource.shards(resource.data)
+
+        self.assertEqual({name: sorted(entries) for name, entries in shards.items()}, {
+            'operator': ['char_002_amiya', 'char_003_kalts'],
+            'enemy': ['enemy_1000_gopro'],
+            'special': ['doctor'],
+        })
+
+    async def test_uploads_only_changed_shards(self):
+        resource = self.make_resource()
+        resource.load_shard_manifest = lambda: None
+        manifest = await resource.publish_shards(resource.data, 'v1')
+
+        self.assertEqual([call.args[0] for call in resource.upload.await_args_list], [
+            'char/test/enemy.json', 'char/test/operator.json', 'char/test/special.json', 'char/test.shards.json'
+        ])
+        self.assertEqual(manifest['shards']['operator']['count'], 2)
+        operator = resource.upload.await_args_list[1].args[1]
+        self.assertEqual(json.loads(operator).keys(), {'char_002_amiya', 'char_003_kalts'})
+
+        resource.upload.reset_mock()
+        resource.load_shard_manifest = lambda: manifest
+        resource.char('enemy_1000_gopro').add_name('en_US', 'Originium Slug')
+        changed = await resource.publish_shards(resource.data, 'v2')
+
+        self.assertEqual([call.args[0] for call in resource.upload.await_args_list], [
+            'char/test/enemy.json', 'char/test.shards.json'
+        ])
+        self.assertEqual(changed['shards']['operator'], manifest['shards']['operator'])
+        self.assertNotEqual(changed['shards']['enemy']['hash'], manifest['shards']['enemy']['hash'])
+
+
+class UpdateVariantsTests(unittest.IsolatedAsyncioTestCase):
+    async def test_variant_list_waits_for_every_avatar(self):
+        resource = make_resource()
+        resource.publish = AsyncMock()
+        resource.git = MagicMock()
+        failing = {'char_002_amiya_2'}
+        resource.upload_avatar = AsyncMock(side_effect=lambda char, avatar, semaphore: avatar not in failing or None)
+
+        async def remote_version():
+            return resource.version
+
+        cwd = os.getcwd()
+        with TemporaryDirectory() as directory, \
+                patch.object(Resource, 'remote_version', new_callable=PropertyMock) as remote:
+            remote.side_effect = remote_version
+            os.chdir(directory)
+            try:
+                resource.save_manifest({})
+                resource.save_shard_manifest({'version': resource.version, 'shards': {}})
+
+                await resource._update()
+                self.assertIsNone(resource.load_variants())
+                self.assertNotIn(('avatar/test.variants.json',),
+                                 [call.args[:1] for call in resource.publish.await_args_list])
+
+                failing.clear()
+                resource.upload_avatar.reset_mock()
+                await resource._update()
+                self.assertEqual(resource.upload_avatar.await_count, 3)
+                self.assertEqual(resource.load_variants(), resource.variants_document)
+                self.assertEqual(resource.publish.await_args.args[0], 'avatar/test.variants.json')
+            finally:
+                os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()
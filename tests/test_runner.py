@@ -0,0 +1,58 @@
+import asyncio
+import unittest
+from unittest.mock import Mock, patch
+
+from util.git import GitChanges
+from util.runner import Runner
+
+
+class FakeResource:
+    def __init__(self, series: str, error: Exception = None):
+        self.series = series
+        self.error = error
+        self.upload = None
+        self.seen = None
+
+    async def run(self):
+        self.seen = self.upload
+        await asyncio.sleep(0)
+        if self.error is not None:
+            raise self.error
+
+
+class RunnerTests(unittest.IsolatedAsyncioTestCase):
+    async def test_failure_does_not_stop_other_series(self):
+        runner = Runner()
+        ok = runner.register(FakeResource('ok'))
+        broken = runner.register(FakeResource('broken', RuntimeError('boom')))
+
+        with patch('util.metrics.trace_memory', False), patch('util.runner.decoder', Mock()) as decoder:
+            failed = await runner.run()
+
+        self.assertEqual(failed, ['broken'])
+        # both series shared one uploader, released after the run
+        self.assertIsNotNone(ok.seen)
+        self.assertIs(ok.seen, broken.seen)
+        self.assertIsNone(ok.upload)
+        decoder.close.assert_called_once()
+
+
+class GitChangesTests(unittest.TestCase):
+    def test_collects_one_commit(self):
+        changes = GitChanges()
+        self.assertFalse(changes.commit())
+        changes.add('[Arknights UPDATE] Data', 'data', 'version')
+        self.assertEqual(changes.message, '[Arknights UPDATE] Data')
+        changes.add('[Arknights NPC UPDATE] Source', 'version/arknights_npc.source.json', 'version')
+
+        with patch('util.git.subprocess.run') as run, patch.dict('os.environ', {'GITHUB_ENV': ''}):
+            self.assertTrue(changes.commit())
+
+        add, commit = (call.args[0] for call in run.call_args_list)
+        self.assertEqual(add, ['git', 'add', 'data', 'version', 'version/arknights_npc.source.json'])
+        self.assertTrue(commit[3].endswith('\n\n[Arknights UPDATE] Data\n[Arknights NPC UPDATE] Source'))
+        self.assertEqual(changes.messages, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
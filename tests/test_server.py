@@ -0,0 +1,240 @@
+import asyncio
+import gzip
+import importlib.util
+import json
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from util.search import SearchIndex
+
+spec = importlib.util.spec_from_file_location('server', Path(__file__).resolve().parent.parent / 'scripts' / 'server.py')
+server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(server)
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.base_dir = server.base_dir
+        server.base_dir = Path(self.directory.name)
+        (server.base_dir / 'data').mkdir()
+        (server.base_dir / 'version').mkdir()
+        server.series_data.clear()
+
+    def tearDown(self):
+        server.base_dir = self.base_dir
+        server.series_data.clear()
+        self.directory.cleanup()
+
+    def request(self, **headers) -> server.Request:
+        return server.Request({
+            'type': 'http',
+            'headers': [(key.replace('_', '-').encode(), value.encode()) for key, value in headers.items()],
+        })
+
+    def publish(self, version: str, data: dict):
+        (server.base_dir / 'data' / 'test.json').write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+        (server.base_dir / 'version' / 'test.txt').write_text(version, encoding='utf-8')
+
+
+class SeriesPathTests(ServerTestCase):
+    def test_resolves_existing_series(self):
+        self.publish('v1', {})
+
+        self.assertEqual(server.series_path('data', 'test', '.json'), (server.base_dir / 'data' / 'test.json').resolve())
+
+    def test_rejects_traversal_and_missing_files(self):
+        self.publish('v1', {})
+        (server.base_dir / 'secret.json').write_text('{}', encoding='utf-8')
+
+        for series in ('../secret', '..', 'a/b', 'test.json', '', 'missing'):
+            with self.subTest(series=series), self.assertRaises(server.HTTPException) as context:
+                server.series_path('data', series, '.json')
+            self.assertEqual(context.exception.status_code, 404)
+
+
+class SeriesDataTests(ServerTestCase):
+    def test_patch_since_known_version(self):
+        self.publish('v1', {'a': [['A'], [''], []], 'b': [['B'], [''], []]})
+        server.load_series('test')
+        self.publish('v2', {'a': [['A'], ['', '_2'], []], 'c': [['C'], [''], []]})
+
+        patch = json.loads(server.load_series('test').patch('v1').raw)
+
+        self.assertEqual(patch['from'], 'v1')
+        self.assertEqual(patch['to'], 'v2')
+        self.assertEqual(patch['added'], {'c': [['C'], [''], []]})
+        self.assertEqual(patch['changed'], {'a': [['A'], ['', '_2'], []]})
+        self.assertEqual(patch['removed'], ['b'])
+
+    def test_unknown_version_has_no_patch(self):
+        self.publish('v1', {'a': [['A'], [''], []]})
+
+        self.assertIsNone(server.load_series('test').patch('v0'))
+
+    def test_keeps_only_recent_versions(self):
+        for i in range(server.SeriesData.history_size + 2):
+            self.publish(f'v{i}', {'a': [[str(i)], [''], []]})
+            server.load_series('test')
+
+        history = server.series_data['test'].history
+        self.assertEqual(len(history), server.SeriesData.history_size)
+        self.assertNotIn('v0', history)
+
+    def test_unknown_series_is_not_kept(self):
+        self.publish('v1', {})
+
+        for series in ('missing', '..', 'test'):
+            try:
+                server.load_series(series)
+            except server.HTTPException:
+                pass
+
+        self.assertEqual(list(server.series_data), ['test'])
+
+    def test_version_has_one_format_in_every_mode(self):
+        self.publish('v1', {})
+        mode = server.config.server.mode
+        try:
+            for server.config.server.mode in ('cache', 'static'):
+                with self.subTest(mode=server.config.server.mode):
+                    self.assertEqual(asyncio.run(server.get_version('test')), 'v1')
+        finally:
+            server.config.server.mode = mode
+
+
+class SearchTests(ServerTestCase):
+    data = {
+        'char_002_amiya': [['阿米娅', '阿米婭', 'amiya', 'amy', 'Amiya', 'アーミヤ', 'R001'], [''], ['operator']],
+        'char_1001_amiya2': [['阿米娅(近卫)', 0, 'amiya(jinwei)', 0, 'Amiya (Guard)', 0, 0], [''], ['operator']],
+        'token_amiya': [['阿米娅的弓', 0, 'amiyadegong', 0, 0, 0, 0], [''], ['token']],
+        'char_003_kalts': [['凯尔希', '凱爾希', 'kaerxi', 'kex', 'Kal\'tsit', 'ケルシー', 'AM01'], [''], ['operator']],
+    }
+
+    def test_ranks_exact_then_prefix_then_substring(self):
+        index = SearchIndex(self.data)
+
+        self.assertEqual(index.search('阿米娅'), ['char_002_amiya', 'char_1001_amiya2', 'token_amiya'])
+        self.assertEqual(index.search('AMIYA', limit=2), ['char_002_amiya', 'char_1001_amiya2'])
+        self.assertEqual(index.search('r001'), ['char_002_amiya'])
+        self.assertEqual(index.search('kex'), ['char_003_kalts'])
+        self.assertEqual(index.search('guard'), ['char_1001_amiya2'])
+        self.assertEqual(index.search('尔希'), ['char_003_kalts'])
+        self.assertEqual(index.search('ケル'), ['char_003_kalts'])
+        self.assertEqual(index.search('amiya', tag='token'), ['token_amiya'])
+        self.assertEqual(index.search('  '), [])
+        self.assertEqual(index.search('doctor'), [])
+
+    def test_index_is_rebuilt_only_for_a_new_version(self):
+        self.publish('v1', self.data)
+        index = server.load_series('test').index
+        self.publish('v1', self.data)
+        self.assertIs(server.load_series('test').index, index)
+
+        self.publish('v2', {'char_003_kalts': self.data['char_003_kalts']})
+        self.assertEqual(server.load_series('test').index.search('阿米娅'), [])
+
+
+class BodyTests(ServerTestCase):
+    def test_serves_precompressed_body_with_etag(self):
+        self.publish('v1', {'a': [['A'], [''], []]})
+        body = server.load_series('test').body
+
+        response = body.response(self.request(accept_encoding='gzip, deflate'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['etag'], '"v1-gz"')
+        self.assertEqual(response.headers['content-encoding'], 'gzip')
+        self.assertEqual(body.response(self.request()).headers['etag'], '"v1"')
+        self.assertEqual(json.loads(gzip.decompress(response.body)), {'a': [['A'], [''], []]})
+
+    def test_respects_accept_encoding_q_values(self):
+        self.publish('v1', {'a': [['A'], [''], []]})
+        body = server.load_series('test').body
+        body.br = b'br-body'
+
+        for accept_encoding, expected in (('br;q=0, gzip', 'gzip'), ('gzip, br', 'br'), ('gzip;q=1, br;q=0.5', 'gzip'),
+                                          ('*', 'br'), ('br;q=0, gzip;q=0', None), ('identity', None)):
+            with self.subTest(accept_encoding=accept_encoding):
+                response = body.response(self.request(accept_encoding=accept_encoding))
+                self.assertEqual(response.headers.get('content-encoding'), expected)
+
+    def test_matching_etag_returns_not_modified(self):
+        self.publish('v1', {'a': [['A'], [''], []]})
+        body = server.load_series('test').body
+
+        response = body.response(self.request(if_none_match='"v0", "v1"'))
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.body, b'')
+        for etag in ('"v1-gz"', '"v1-br"'):
+            with self.subTest(etag=etag):
+                self.assertEqual(body.response(self.request(if_none_match=etag)).status_code, 304)
+        self.assertEqual(body.response(self.request(if_none_match='"v0-gz"')).status_code, 200)
+
+    def test_reloads_when_data_file_changes(self):
+        self.publish('v1', {'a': [['A'], [''], []]})
+        first = server.load_series('test').body
+        self.assertIs(server.load_series('test').body, first)
+
+        self.publish('v2', {'b': [['B'], [''], []]})
+
+        self.assertEqual(server.load_series('test').body.etag, '"v2"')
+
+
+class EntryTests(ServerTestCase):
+    data = {'a': [['A'], [''], ['operator']], 'b': [['B'], [''], ['enemy']]}
+
+    def test_entry_has_its_own_etag(self):
+        self.publish('v1', self.data)
+        series = server.load_series('test')
+
+        response = series.entry('a').response(self.request(accept_encoding='gzip'))
+
+        self.assertEqual(json.loads(response.body), self.data['a'])
+        self.assertNotIn('content-encoding', response.headers)
+        self.assertNotEqual(response.headers['etag'], series.entry('b').etag)
+        self.assertIsNone(series.entry('missing'))
+        not_modified = series.entry('a').response(self.request(if_none_match=response.headers['etag']))
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_entry_etag_survives_unrelated_changes(self):
+        self.publish('v1', self.data)
+        etag = server.load_series('test').entry('a').etag
+
+        self.publish('v2', {**self.data, 'b': [['B2'], [''], ['enemy']]})
+        series = server.load_series('test')
+
+        self.assertEqual(series.entry('a').etag, etag)
+        self.assertEqual(json.loads(series.entry('b').raw), [['B2'], [''], ['enemy']])
+
+    def test_batch_returns_existing_entries(self):
+        self.publish('v1', self.data)
+        series = server.load_series('test')
+
+        batch = series.batch(['b', 'missing', 'a', 'b'])
+
+        self.assertEqual(json.loads(batch.raw), {'b': self.data['b'], 'a': self.data['a']})
+        self.assertEqual(series.batch(['a', 'b']).etag, series.batch(['a', 'b', 'missing']).etag)
+        self.assertNotEqual(series.batch(['a']).etag, batch.etag)
+
+    def test_batch_is_encoded_once_per_version(self):
+        self.publish('v1', self.data)
+        series = server.load_series('test')
+
+        batch = series.batch(['a', 'b'])
+
+        self.assertIs(series.batch(['b', 'a', 'missing']), batch)
+        self.publish('v2', {**self.data, 'b': [['B2'], [''], ['enemy']]})
+        self.assertIsNot(server.load_series('test').batch(['a', 'b']), batch)
+
+        series = server.load_series('test')
+        series.batch_cache = 2
+        for char_ids in (['a'], ['b'], ['a'], ['a', 'b']):
+            series.batch(char_ids)
+        self.assertEqual(list(series.batches), [('a',), ('a', 'b')])
+
+
+if __name__ == '__main__':
+    unittest.main()
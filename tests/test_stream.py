@@ -0,0 +1,30 @@
+import json
+import unittest
+
+from util.stream import ObjectStream, iter_object
+
+
+class ObjectStreamTests(unittest.TestCase):
+    def test_yields_items_across_any_chunking(self):
+        document = {
+            'levelInfoList': [{'level': 1}],
+            'enemyData': {f'enemy_{i}': {'name': '源石虫' * i, 'enemyIndex': f'B{i}', 'hp': i * 1.5} for i in range(50)},
+            'count': 12345,
+        }
+        raw = json.dumps(document, ensure_ascii=False, indent=2).encode('utf-8')
+        expected = [('levelInfoList', [{'level': 1}]), *document['enemyData'].items(), ('count', 12345)]
+
+        for size in (1, 2, 7, 100, len(raw)):
+            with self.subTest(size=size):
+                chunks = [raw[i:i + size] for i in range(0, len(raw), size)]
+                self.assertEqual(list(iter_object(chunks, ('enemyData',))), expected)
+
+    def test_rejects_truncated_document(self):
+        stream = ObjectStream()
+        self.assertEqual(list(stream.feed(b'{"a": {"name": "A"}, "b": {')), [('a', {'name': 'A'})])
+        with self.assertRaises(ValueError):
+            list(stream.feed(b'', True))
+
+
+if __name__ == '__main__':
+    unittest.main()
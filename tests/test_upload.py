@@ -0,0 +1,138 @@
+import asyncio
+import json
+import os
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from util.ledger import UploadLedger, content_sha
+from util.upload import Uploader
+
+
+class UploaderTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.statuses = []
+        self.received = []
+        self.batches = []
+
+        async def upload(request: web.Request):
+            form = await request.post()
+            if self.body is not None:
+                return web.Response(text=self.body)
+            if request.query.get('batch'):
+                if self.batch_status != 200:
+                    return web.json_response({'code': self.batch_status}, status=self.batch_status)
+                paths = form.getall('path')
+                self.batches.append(paths)
+                return web.json_response({'code': 200, 'data': {path: 200 for path in paths}})
+            status = self.statuses.pop(0) if self.statuses else 200
+            if status != 200:
+                return web.json_response({'code': status}, status=status)
+            self.received.append(request.query['path'])
+            return web.json_response({'code': 200})
+
+        self.batch_status = 200
+        # a 200 answered with this body instead of json
+        self.body = None
+        app = web.Application()
+        app.router.add_put('/upload', upload)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.patcher = patch('util.upload.server', str(self.server.make_url('/upload')))
+        self.patcher.start()
+        self.uploader = Uploader()
+        self.uploader.backoff = 0
+
+    async def asyncTearDown(self):
+        await self.uploader.close()
+        self.patcher.stop()
+        await self.server.close()
+
+    async def test_retries_server_errors(self):
+        self.statuses = [500, 503]
+        result = await self.uploader('a.png', b'a')
+        self.assertTrue(result)
+        self.assertEqual(result.attempts, 3)
+        self.assertEqual(self.received, ['a.png'])
+
+    async def test_client_error_is_reported_without_retry(self):
+        self.statuses = [403]
+        result = await self.uploader('a.png', b'a')
+        self.assertFalse(result)
+        self.assertEqual(result.status, 403)
+        self.assertEqual(result.attempts, 1)
+        self.assertEqual(self.uploader.failed, [result])
+
+    async def test_gives_up_after_retries(self):
+        self.uploader.retries = 1
+        self.statuses = [500, 500, 500]
+        result = await self.uploader('a.png', b'a')
+        self.assertFalse(result)
+        self.assertEqual(result.attempts, 2)
+
+    async def test_batches_small_files(self):
+        self.uploader.batch_size = 3
+        results = await asyncio.gather(*[self.uploader(f'{i}.png', b'x') for i in range(4)])
+        self.assertTrue(all(results))
+        self.assertEqual(self.batches, [['0.png', '1.png', '2.png'], ['3.png']])
+        self.assertEqual(self.received, [])
+
+    async def test_invalid_response_fails_each_file(self):
+        for body in ('OK', '[200]'):
+            with self.subTest(body=body):
+                self.body = body
+                self.uploader.batch_size = 0
+                result = await self.uploader('a.png', b'a')
+                self.assertFalse(result)
+                self.assertEqual(result.status, 200)
+
+                self.uploader.batch_size = 2
+                results = await asyncio.gather(self.uploader('b.png', b'b'), self.uploader('c.png', b'c'))
+                self.assertEqual([result.path for result in results if not result], ['b.png', 'c.png'])
+
+    async def test_refused_batch_falls_back_to_single_uploads(self):
+        self.uploader.batch_size = 2
+        self.batch_status = 404
+        results = await asyncio.gather(self.uploader('a.png', b'a'), self.uploader('b.png', b'b'))
+        self.assertTrue(all(results))
+        self.assertEqual(sorted(self.received), ['a.png', 'b.png'])
+        self.assertEqual(self.uploader.batch_size, 0)
+
+    async def test_ledger_skips_identical_content(self):
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ledger.json')
+            self.uploader.ledger = UploadLedger(path, 'server')
+            self.assertTrue(await self.uploader('a.png', b'a'))
+            await self.uploader.close()
+
+            uploader = Uploader(ledger=UploadLedger(path, 'server'))
+            skipped = await uploader('a.png', b'a')
+            changed = await uploader('a.png', b'b')
+            await uploader.close()
+            self.assertTrue(skipped.skipped)
+            self.assertFalse(changed.skipped)
+            self.assertEqual(self.received, ['a.png', 'a.png'])
+
+            # the file is cached by the workflow, the server url is kept as a hash
+            self.assertEqual(json.loads(Path(path).read_text(encoding='utf-8'))['server'], content_sha(b'server'))
+
+            # entries recorded against another server are not trusted
+            uploader = Uploader(ledger=UploadLedger(path, 'other'))
+            self.assertFalse((await uploader('a.png', b'b')).skipped)
+            await uploader.close()
+
+    async def test_ledger_does_not_record_failures(self):
+        with TemporaryDirectory() as directory:
+            self.uploader.ledger = UploadLedger(os.path.join(directory, 'ledger.json'), 'server')
+            self.statuses = [403]
+            self.assertFalse(await self.uploader('a.png', b'a'))
+            self.assertTrue(await self.uploader('a.png', b'a'))
+            self.assertEqual(self.received, ['a.png'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
 from resources.arknights import ArknightsResource
 from resources.arknights_npc import ArknightsNPCResource
+from util.runner import Runner
 
-ArknightsResource.start()
-# ArknightsNPCResource.start()
+runner = Runner()
+runner.register(ArknightsResource)
+runner.register(ArknightsNPCResource)
+runner.start()
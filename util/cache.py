@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Union
+
+blob_cache_dir = os.environ.get('BLOB_CACHE_DIR', '.cache/blob')
+# megabytes; the directory is saved to the workflow cache, keep it well below the repository quota
+blob_cache_size = int(os.environ.get('BLOB_CACHE_SIZE', 256)) * 1024 * 1024
+
+
+def git_blob_sha(byte: bytes) -> str:
+    """Sha1 of a file as git stores it, comparable with the sha of a tree entry."""
+    return hashlib.sha1(b'blob %d\0' % len(byte) + byte).hexdigest()
+
+
+class BlobCache:
+    """On-disk cache addressed by upstream git blob sha, evicting least recently used files."""
+
+    def __init__(self, root: Union[str, Path] = blob_cache_dir, max_size: int = blob_cache_size):
+        self.root: Path = Path(root)
+        self.max_size: int = max_size
+        self.size: Optional[int] = None
+
+    def path(self, sha: str, kind: str) -> Path:
+        return self.root / sha[:2] / f'{sha}.{kind}'
+
+    def get(self, sha: str, kind: str) -> Optional[bytes]:
+        path = self.path(sha, kind)
+        try:
+            byte = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        # mtime records the last use, eviction drops the oldest first
+        os.utime(path)
+        return byte
+
+    def put(self, sha: str, kind: str, byte: bytes):
+        path = self.path(sha, kind)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_bytes(byte)
+        tmp.replace(path)
+        if self.size is None:
+            self.size = sum(file.stat().st_size for file in self.files())
+        else:
+            self.size += len(byte)
+        if self.size > self.max_size:
+            self.evict()
+
+    def files(self):
+        if not self.root.exists():
+            return []
+        return [file for file in self.root.glob('*/*') if not file.name.endswith('.tmp')]
+
+    def evict(self):
+        files = sorted(((file.stat(), file) for file in self.files()), key=lambda x: x[0].st_mtime)
+        self.size = sum(stat.st_size for stat, _ in files)
+        for stat, file in files:
+            if self.size <= self.max_size:
+                break
+            file.unlink(missing_ok=True)
+            self.size -= stat.st_size
+
+
+http_cache_dir = os.environ.get('HTTP_CACHE_DIR', '.cache/http')
+
+
+class ResponseCache:
+    """Upstream response bodies with their ETag/Last-Modified validators, plus parsed results.
+
+    Results are stored as json, the directory is restored from a shared cache
+    and must never hold anything that runs code when it is loaded.
+    """
+
+    def __init__(self, root: Union[str, Path] = http_cache_dir):
+        self.root: Path = Path(root)
+        # body sha1 -> parsed object, for bodies already parsed during this run
+        self.parsed: Dict[str, Any] = {}
+
+    def path(self, url: str, kind: str) -> Path:
+        return self.root / f'{hashlib.sha1(url.encode("utf-8")).hexdigest()}.{kind}'
+
+    def meta(self, url: str) -> Optional[dict]:
+        try:
+            meta = json.loads(self.path(url, 'json').read_text(encoding='utf-8'))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return meta if meta.get('url') == url and self.path(url, 'body').exists() else None
+
+    def validators(self, url: str) -> Dict[str, str]:
+        """Conditional request headers for a cached response."""
+        meta = self.meta(url) or {}
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def body(self, url: str) -> bytes:
+        return self.path(url, 'body').read_bytes()
+
+    def chunks(self, url: str, size: int = 1 << 16) -> Iterator[bytes]:
+        with self.path(url, 'body').open(mode='rb') as f:
+            while chunk := f.read(size):
+                yield chunk
+
+    def put(self, url: str, body: bytes, etag: Optional[str], last_modified: Optional[str]):
+        writer = self.writer(url)
+        writer.write(body)
+        writer.commit(etag, last_modified)
+
+    def writer(self, url: str) -> 'BodyWriter':
+        return BodyWriter(self, url)
+
+    def clear_results(self, url: str):
+        for path in self.root.glob(self.path(url, '*.result.json').name):
+            path.unlink(missing_ok=True)
+
+    def load_result(self, url: str, name: str, sha1: str) -> Optional[Any]:
+        """A result derived from the body with this sha1 by an earlier run, None when absent."""
+        try:
+            cached = json.loads(self.path(url, f'{name}.result.json').read_text(encoding='utf-8'))
+        except (FileNotFoundError, ValueError):
+            return None
+        if not isinstance(cached, dict) or cached.get('sha1') != sha1:
+            return None
+        return cached.get('result')
+
+    def save_result(self, url: str, name: str, sha1: str, result: Any):
+        meta = self.meta(url)
+        if meta is not None and meta.get('sha1') == sha1:
+            self.path(url, f'{name}.result.json').write_text(
+                json.dumps({'sha1': sha1, 'result': result}, ensure_ascii=False, separators=(',', ':')),
+                encoding='utf-8')
+
+    async def parse(self, url: str, body: bytes, loads: Callable[[bytes], Awaitable[Any]]) -> Any:
+        """await loads(body), reusing the result of an earlier run when the body is unchanged."""
+        sha1 = hashlib.sha1(body).hexdigest()
+        if sha1 in self.parsed:
+            return self.parsed[sha1]
+        result = self.load_result(url, 'json', sha1)
+        if result is None:
+            result = await loads(body)
+            self.save_result(url, 'json', sha1, result)
+        self.parsed[sha1] = result
+        return result
+
+
+class BodyWriter:
+    """Write a response body to the cache while it streams in, published by commit."""
+
+    def __init__(self, cache: ResponseCache, url: str):
+        self.cache: ResponseCache = cache
+        self.url: str = url
+        self.sha1 = hashlib.sha1()
+        self.cache.root.mkdir(parents=True, exist_ok=True)
+        self.tmp: Path = cache.path(url, 'body.tmp')
+        self.file = self.tmp.open(mode='wb')
+
+    def write(self, chunk: bytes):
+        self.sha1.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self, etag: Optional[str], last_modified: Optional[str]) -> str:
+        """Store the body with its validators and return its sha1."""
+        self.file.close()
+        sha1 = self.sha1.hexdigest()
+        if not etag and not last_modified:
+            self.tmp.unlink(missing_ok=True)
+            return sha1
+        self.cache.clear_results(self.url)
+        self.tmp.replace(self.cache.path(self.url, 'body'))
+        self.cache.path(self.url, 'json').write_text(json.dumps({
+            'url': self.url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'sha1': sha1
+        }), encoding='utf-8')
+        return sha1
+
+    def abort(self):
+        self.file.close()
+        self.tmp.unlink(missing_ok=True)
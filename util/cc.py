@@ -1,14 +1,31 @@
-__all__ = ['s2t']
-
-import opencc
-
-
-class CC:
-    def __init__(self, config: str):
-        self.converter: opencc.OpenCC = opencc.OpenCC(config)
-
-    def __call__(self, text: str) -> str:
-        return self.converter.convert(text)
-
-
-s2t = CC('s2t')
+__all__ = ['s2t']
+
+from typing import List
+
+
+class CC:
+    def __init__(self, config: str):
+        self.config: str = config
+        self._converter = None
+
+    @property
+    def converter(self):
+        # opencc is imported and its dictionaries loaded on first use only
+        if self._converter is None:
+            import opencc
+            self._converter = opencc.OpenCC(self.config)
+        return self._converter
+
+    def __call__(self, text: str) -> str:
+        return self.converter.convert(text)
+
+    def batch(self, texts: List[str]) -> List[str]:
+        """Convert several texts with a single OpenCC call."""
+        if not texts:
+            return []
+        if any('\n' in text for text in texts):
+            return [self(text) for text in texts]
+        return self.converter.convert('\n'.join(texts)).split('\n')
+
+
+s2t = CC('s2t')
@@ -1,6 +1,12 @@
-static_url = 'https://static.mayertalk.top/'
-data_url = 'char/%s.json'
-special_data_url = 'char/%s.spec.json'
-version_url = 'version/char/%s.txt'
-
-lang_order = ['zh_CN', 'zh_TW', 'py', 'fpy', 'en_US', 'ja_JP', 'code']
+static_url = 'https://static.mayertalk.top/'
+data_url = 'char/%s.json'
+packed_data_url = 'char/%s.bin'
+special_data_url = 'char/%s.spec.json'
+patch_url = 'char/%s.patch/%s.json'
+patch_index_url = 'char/%s.patch.json'
+shard_url = 'char/%s/%s.json'
+shard_manifest_url = 'char/%s.shards.json'
+variants_url = 'avatar/%s.variants.json'
+version_url = 'version/char/%s.txt'
+
+lang_order = ['zh_CN', 'zh_TW', 'py', 'fpy', 'en_US', 'ja_JP', 'code']
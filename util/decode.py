@@ -0,0 +1,35 @@
+import os
+import json
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Optional, Union
+
+decode_threshold = int(os.environ.get('DECODE_THRESHOLD', 1 << 20))
+
+
+class JSONDecoder:
+    """Decode large json payloads in worker processes.
+
+    json.loads holds the GIL, so a thread would still stall the event loop;
+    payloads below threshold are decoded inline where a round trip costs more.
+    """
+
+    def __init__(self, threshold: int = decode_threshold, workers: Optional[int] = None):
+        self.threshold: int = threshold
+        self.workers: Optional[int] = workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    async def loads(self, body: Union[str, bytes]) -> Any:
+        if len(body) < self.threshold:
+            return json.loads(body)
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, json.loads, body)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+decoder = JSONDecoder()
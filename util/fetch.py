@@ -0,0 +1,177 @@
+import time
+import random
+import asyncio
+import aiohttp
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Mapping, Optional, Tuple
+from urllib.parse import urlsplit
+
+from . import metrics
+
+
+@dataclass
+class FetchResponse:
+    url: str
+    status: int
+    headers: Mapping[str, str]
+    body: bytes
+    charset: Optional[str] = None
+
+    def text(self) -> str:
+        return self.body.decode(self.charset or 'utf-8')
+
+
+class Fetcher:
+    """The one http client every resource downloads through.
+
+    Requests share a keep-alive pool and are capped per host. Identical GETs in
+    flight at the same time are sent once. 5xx, 429 and connection errors are
+    retried with exponential backoff and full jitter, and a GitHub rate limit
+    (X-RateLimit-Remaining: 0 / Retry-After) is waited out up to max_rate_wait
+    instead of failing. The final response is returned whatever its status,
+    callers decide what a 404 means.
+    """
+    limits = {
+        'github.com': 8,
+        'api.github.com': 4,
+        'raw.githubusercontent.com': 16,
+    }
+    default_limit = 16
+    retries = 3
+    backoff = 1.0
+    max_rate_wait = 15 * 60
+    timeout = aiohttp.ClientTimeout(total=300, sock_connect=10, sock_read=60)
+
+    def __init__(self):
+        self.client: Optional[aiohttp.ClientSession] = None
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.inflight: Dict[Tuple[str, tuple], asyncio.Future] = {}
+        # host -> timestamp its rate limit resets
+        self.blocked: Dict[str, float] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self.client is None:
+            self.client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=sum(self.limits.values()) + self.default_limit,
+                                               keepalive_timeout=30, ttl_dns_cache=300),
+                timeout=self.timeout
+            )
+        return self.client
+
+    def semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.limits.get(host, self.default_limit))
+        return self.semaphores[host]
+
+    async def wait(self, host: str):
+        delay = self.blocked.get(host, 0) - time.time()
+        if 0 < delay <= self.max_rate_wait:
+            print(f'wait {delay:.0f}s for {host} rate limit')
+            await asyncio.sleep(delay)
+
+    def rate_limit(self, host: str, status: int, headers) -> Optional[float]:
+        """Seconds until the host accepts requests again, None when not rate limited."""
+        reset = headers.get('X-RateLimit-Reset')
+        if headers.get('X-RateLimit-Remaining') == '0' and reset and reset.isdigit():
+            # later requests to the host wait too, instead of spending their retries on 403
+            self.blocked[host] = int(reset) + 1
+        if status not in (403, 429):
+            return None
+        retry_after = headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        if host in self.blocked and headers.get('X-RateLimit-Remaining') == '0':
+            return max(self.blocked[host] - time.time(), 0)
+        return None
+
+    def retry_delay(self, host: str, status: int, headers, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying a response, None when it is final."""
+        if attempt > self.retries:
+            return None
+        delay = self.rate_limit(host, status, headers)
+        if delay is not None:
+            return delay if delay <= self.max_rate_wait else None
+        if status >= 500 or status == 429:
+            return random.uniform(0, self.backoff * 2 ** (attempt - 1))
+        return None
+
+    async def attempt(self, url: str, attempt: int, error: Exception):
+        if attempt > self.retries:
+            raise error
+        delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+        print(f'retry get {url} in {delay:.2f}s ({str(error) or type(error).__name__})')
+        await asyncio.sleep(delay)
+
+    async def _get(self, url: str, headers: Optional[Dict[str, str]]) -> FetchResponse:
+        host = urlsplit(url).hostname or ''
+        async with self.semaphore(host):
+            attempt = 0
+            while True:
+                attempt += 1
+                await self.wait(host)
+                try:
+                    async with self.session.get(url, headers=headers) as r:
+                        delay = self.retry_delay(host, r.status, r.headers, attempt)
+                        if delay is None:
+                            body = await r.read()
+                            metrics.request(url, len(body))
+                            return FetchResponse(url, r.status, r.headers, body, r.charset)
+                        metrics.request(url)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    await self.attempt(url, attempt, e)
+                    continue
+                print(f'retry get {url} in {delay:.2f}s ({r.status})')
+                await asyncio.sleep(delay)
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None) -> FetchResponse:
+        """GET url with its body read, sharing the request with identical ones in flight."""
+        key = (url, tuple(sorted((headers or {}).items())))
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._get(url, headers))
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # one waiter being cancelled must not cancel the request for the others
+        return await asyncio.shield(future)
+
+    @asynccontextmanager
+    async def stream(self, url: str, headers: Optional[Dict[str, str]] = None) -> AsyncIterator[aiohttp.ClientResponse]:
+        """GET url and yield the response unread, for bodies consumed chunk by chunk.
+
+        Only opening the response is retried, the host slot is held until the body is consumed.
+        """
+        host = urlsplit(url).hostname or ''
+        async with self.semaphore(host):
+            attempt = 0
+            while True:
+                attempt += 1
+                await self.wait(host)
+                try:
+                    r = await self.session.get(url, headers=headers)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    await self.attempt(url, attempt, e)
+                    continue
+                delay = self.retry_delay(host, r.status, r.headers, attempt)
+                if delay is None:
+                    break
+                r.release()
+                metrics.request(url)
+                print(f'retry get {url} in {delay:.2f}s ({r.status})')
+                await asyncio.sleep(delay)
+            try:
+                yield r
+            finally:
+                r.release()
+                metrics.request(url, r.content.total_bytes)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+        # semaphores belong to the loop they were used on
+        self.semaphores.clear()
+
+
+fetcher = Fetcher()
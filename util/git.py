@@ -0,0 +1,40 @@
+import os
+import subprocess
+from typing import List
+
+from .time import get_time
+
+
+class GitChanges:
+    """Files changed by resource runs, committed together once every run has finished."""
+
+    def __init__(self):
+        self.paths: List[str] = []
+        self.messages: List[str] = []
+
+    def add(self, message: str, *paths: str):
+        self.paths.extend(path for path in paths if path not in self.paths)
+        self.messages.append(message)
+
+    @property
+    def message(self) -> str:
+        if len(self.messages) == 1:
+            return self.messages[0]
+        return f'[UPDATE] {get_time()}\n\n' + '\n'.join(self.messages)
+
+    def commit(self) -> bool:
+        """Commit the recorded changes and flag the workflow to push them, False when there are none."""
+        if not self.messages:
+            return False
+        subprocess.run(['git', 'add', *self.paths], check=True)
+        subprocess.run(['git', 'commit', '-m', self.message], check=True)
+        github_env = os.environ.get('GITHUB_ENV')
+        if github_env:
+            with open(github_env, mode='a', encoding='utf-8') as f:
+                f.write('update=1\n')
+        self.paths.clear()
+        self.messages.clear()
+        return True
+
+
+changes = GitChanges()
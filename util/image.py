@@ -0,0 +1,92 @@
+import os
+import time
+import asyncio
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+from . import metrics
+
+
+class Variant(NamedTuple):
+    """A downscaled webp of an avatar, published next to it as <avatar>@<size>.webp."""
+    size: int
+    quality: int = 80
+    lossless: bool = False
+
+    @property
+    def suffix(self) -> str:
+        return f'@{self.size}.webp'
+
+    @property
+    def kind(self) -> str:
+        """Blob cache kind, changing the settings of a size does not reuse its old encodes."""
+        return f'{self.size}q{self.quality}{"l" if self.lossless else ""}.webp'
+
+    @property
+    def document(self) -> dict:
+        return {'size': self.size, 'quality': self.quality, 'lossless': self.lossless, 'suffix': self.suffix}
+
+
+# the image cannot be decoded or encoded, it fails the same way on every try
+class ImageError(Exception):
+    pass
+
+
+def encode_avatar(byte: bytes, variants: Tuple[Variant, ...] = ()) -> Tuple[bytes, Dict[Variant, bytes], float]:
+    """Webp and variants of an image from a single decode, with the seconds it took."""
+    try:
+        return _encode_avatar(byte, variants)
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        # pillow reports broken images with any of these, re-raised as one picklable type
+        raise ImageError(f'{type(e).__name__}: {e}') from None
+
+
+def _encode_avatar(byte: bytes, variants: Tuple[Variant, ...]) -> Tuple[bytes, Dict[Variant, bytes], float]:
+    start = time.perf_counter()
+    im = Image.open(BytesIO(byte))
+    im.load()
+    out_put = BytesIO()
+    im.save(out_put, 'webp')
+    encoded = {}
+    for variant in variants:
+        small = im.copy()
+        # keeps the aspect ratio and never upscales
+        small.thumbnail((variant.size, variant.size), Image.LANCZOS)
+        out_put_variant = BytesIO()
+        small.save(out_put_variant, 'webp', quality=variant.quality, lossless=variant.lossless)
+        encoded[variant] = out_put_variant.getvalue()
+    return out_put.getvalue(), encoded, time.perf_counter() - start
+
+
+class ImageEncoder:
+    """Encode avatars to webp and their variants in worker processes, off the event loop.
+
+    Every variant of an avatar is encoded by the worker that decoded it, the
+    pool runs avatars in parallel.
+    """
+
+    def __init__(self, workers: Optional[int] = None, variants: Iterable[Variant] = ()):
+        self.workers: int = workers or os.cpu_count() or 1
+        self.variants: Tuple[Variant, ...] = tuple(variants)
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    async def encode(self, byte: bytes) -> Tuple[bytes, bytes, Dict[Variant, bytes]]:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+        webp, variants, seconds = await asyncio.get_running_loop().run_in_executor(
+            self.executor, encode_avatar, byte, self.variants)
+        # time spent encoding in the worker, not waiting for one
+        metrics.count('encode_seconds', seconds)
+        metrics.count('encodes')
+        return byte, webp, variants
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __call__(self, byte: bytes):
+        return self.encode(byte)
@@ -0,0 +1,65 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+upload_ledger_path = os.environ.get('UPLOAD_LEDGER', '.cache/upload_ledger.json')
+upload_server = os.environ.get('SERVER')
+
+
+def content_sha(byte: bytes) -> str:
+    return hashlib.sha256(byte).hexdigest()
+
+
+class UploadLedger:
+    """Sha256 of the content last uploaded to each path, persisted across runs.
+
+    Entries are only trusted for the server they were recorded against; delete
+    the file to force a full re-upload after the server lost files. The file
+    ends up in the workflow cache, so it holds a hash of the server url, never
+    the url itself.
+    """
+    save_every = 64
+
+    def __init__(self, path: Union[str, Path] = upload_ledger_path, server: Optional[str] = upload_server):
+        self.path: Path = Path(path)
+        self.server: Optional[str] = content_sha(server.encode('utf-8')) if server else None
+        # path -> sha256 of the uploaded content
+        self.paths: Optional[Dict[str, str]] = None
+        self.unsaved: int = 0
+
+    def load(self) -> Dict[str, str]:
+        if self.paths is None:
+            self.paths = {}
+            if self.path.exists():
+                try:
+                    data = json.loads(self.path.read_text(encoding='utf-8'))
+                except json.JSONDecodeError:
+                    data = {}
+                if data.get('server') == self.server:
+                    self.paths = data.get('paths', {})
+        return self.paths
+
+    def uploaded(self, path: str, sha: str) -> bool:
+        return self.load().get(path) == sha
+
+    def record(self, path: str, sha: str):
+        self.load()[path] = sha
+        self.unsaved += 1
+        # saved as it goes, so an interrupted run resumes where it stopped
+        if self.unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        if not self.unsaved:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        tmp.write_text(json.dumps({'server': self.server, 'paths': self.paths}, separators=(',', ':')),
+                       encoding='utf-8')
+        tmp.replace(self.path)
+        self.unsaved = 0
+
+
+ledger = UploadLedger()
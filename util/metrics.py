@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import tracemalloc
+from pathlib import Path
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlsplit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+metrics_dir = os.environ.get('METRICS_DIR', '.cache/metrics')
+# name of one phase to capture with cProfile, e.g. PROFILE_PHASE=parse
+profile_phase = os.environ.get('PROFILE_PHASE')
+# per-phase peaks with tracemalloc, TRACE_MEMORY=1; it slows python code down several times
+trace_memory = os.environ.get('TRACE_MEMORY') == '1'
+
+
+def max_rss() -> int:
+    """Peak resident set size of the process in bytes, 0 where unknown."""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Run:
+    """Measurements of one resource run."""
+
+    def __init__(self, name: str):
+        self.name: str = name
+        self.started: float = time.time()
+        self.seconds: float = 0
+        # phase -> wall seconds, phase -> peak traced bytes
+        self.phases: Dict[str, float] = {}
+        self.memory: Dict[str, int] = {}
+        # peak rss of the process when the run ended, always recorded
+        self.max_rss: int = 0
+        # host -> 'requests'/'bytes_in'/'bytes_out'
+        self.hosts: Dict[str, Counter] = defaultdict(Counter)
+        self.counters: Counter = Counter()
+
+    @property
+    def summary(self) -> dict:
+        return {
+            'name': self.name,
+            'started': self.started,
+            'seconds': round(self.seconds, 4),
+            'phases': {phase: round(seconds, 4) for phase, seconds in self.phases.items()},
+            'memory_peak': self.memory,
+            'max_rss': self.max_rss,
+            'hosts': {host: dict(counter) for host, counter in self.hosts.items()},
+            'counters': {name: round(value, 4) for name, value in self.counters.items()},
+        }
+
+    @property
+    def prometheus(self) -> str:
+        run = f'run="{self.name}"'
+        lines = []
+
+        def metric(name: str, kind: str, help: str, samples):
+            lines.append(f'# HELP mayertalk_{name} {help}')
+            lines.append(f'# TYPE mayertalk_{name} {kind}')
+            for labels, value in samples:
+                lines.append(f'mayertalk_{name}{{{",".join([run, *labels])}}} {value}')
+
+        metric('run_seconds', 'gauge', 'Wall time of the run.', [((), round(self.seconds, 4))])
+        metric('run_timestamp_seconds', 'gauge', 'Start of the run.', [((), int(self.started))])
+        metric('phase_seconds', 'gauge', 'Wall time of a phase.',
+               [((f'phase="{phase}"',), round(seconds, 4)) for phase, seconds in self.phases.items()])
+        metric('max_rss_bytes', 'gauge', 'Peak resident set size of the process at the end of the run.',
+               [((), self.max_rss)])
+        metric('phase_memory_peak_bytes', 'gauge', 'Peak memory traced by tracemalloc during a phase.',
+               [((f'phase="{phase}"',), peak) for phase, peak in self.memory.items()])
+        for key, help in (('requests', 'Requests sent.'), ('bytes_in', 'Body bytes received.'),
+                          ('bytes_out', 'Body bytes sent.')):
+            metric(f'http_{key}', 'gauge', help,
+                   [((f'host="{host}"',), counter[key]) for host, counter in sorted(self.hosts.items())])
+        for name, value in sorted(self.counters.items()):
+            metric(name, 'gauge', f'{name} counted during the run.', [((), round(value, 4))])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        for suffix, text in (('.json', json.dumps(self.summary, indent=2)), ('.prom', self.prometheus)):
+            path = directory / f'{self.name}{suffix}'
+            # the textfile collector may read at any time, never let it see half a file
+            tmp = path.with_name(path.name + '.tmp')
+            tmp.write_text(text, encoding='utf-8')
+            tmp.replace(path)
+
+
+current: ContextVar[Optional[Run]] = ContextVar('metrics_run', default=None)
+# only one profiler can be active at a time, concurrent runs entering the same phase skip it
+profiling: bool = False
+
+
+@contextmanager
+def run(name: str, directory: Optional[str] = None) -> Iterator[Run]:
+    """Measure a resource run; tasks started inside report to it. Writes <name>.json and <name>.prom."""
+    record = Run(name)
+    token = current.set(record)
+    tracing = trace_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with phase('total'):
+            yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        record.max_rss = max_rss()
+        if tracing:
+            tracemalloc.stop()
+        current.reset(token)
+        record.write(Path(directory or metrics_dir))
+        print(f'metrics {name} {record.seconds:.2f}s ' +
+              ' '.join(f'{key}={seconds:.2f}s' for key, seconds in record.phases.items() if key != 'total'))
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Wall time and peak memory of a phase of the current run."""
+    record = current.get()
+    if record is None:
+        yield
+        return
+    global profiling
+    # the profiler sees everything the loop runs meanwhile, not only this phase's tasks
+    profiler = cProfile.Profile() if name == profile_phase and not profiling else None
+    if tracemalloc.is_tracing() and name != 'total':
+        tracemalloc.reset_peak()
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiling tool is active, e.g. a coverage run
+            profiler = None
+        else:
+            profiling = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.phases[name] = record.phases.get(name, 0) + time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            profiling = False
+            path = Path(metrics_dir) / f'{record.name}.{name}.prof'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(path)
+            print(f'profile {record.name} {name} {path}')
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            # phases reset the peak, the run keeps the highest of them
+            for key in (name, 'total'):
+                record.memory[key] = max(record.memory.get(key, 0), peak)
+
+
+def request(url: str, bytes_in: int = 0, bytes_out: int = 0):
+    record = current.get()
+    if record is not None:
+        counter = record.hosts[urlsplit(url).hostname or '']
+        counter['requests'] += 1
+        counter['bytes_in'] += bytes_in
+        counter['bytes_out'] += bytes_out
+
+
+def count(name: str, value: float = 1):
+    record = current.get()
+    if record is not None:
+        record.counters[name] += value
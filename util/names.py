@@ -0,0 +1,62 @@
+import os
+import json
+from pathlib import Path
+from importlib.metadata import version as package_version
+from typing import Dict, Iterable, List, Optional, Union
+
+from .cc import s2t
+
+name_cache_path = os.environ.get('NAME_CACHE', '.cache/names.json')
+
+
+class NameCache:
+    """zh_TW, pinyin and pinyin initials derived from zh_CN names, memoized across runs."""
+
+    def __init__(self, path: Union[str, Path] = name_cache_path):
+        self.path: Path = Path(path)
+        # zh_CN name -> [zh_TW, py, fpy]
+        self.names: Optional[Dict[str, List[str]]] = None
+        self.dirty: bool = False
+
+    @property
+    def version(self) -> str:
+        # read from package metadata, importing the converters is what the cache avoids
+        return f'opencc {package_version("opencc")} {s2t.config} pypinyin {package_version("pypinyin")}'
+
+    def load(self) -> Dict[str, List[str]]:
+        if self.names is None:
+            self.names = {}
+            if self.path.exists():
+                try:
+                    data = json.loads(self.path.read_text(encoding='utf-8'))
+                except json.JSONDecodeError:
+                    data = {}
+                # a different converter may derive different names
+                if data.get('version') == self.version:
+                    self.names = data.get('names', {})
+        return self.names
+
+    def derive(self, names: Iterable[str]) -> Dict[str, List[str]]:
+        """Derived names for every name, converting only names not seen before."""
+        cache = self.load()
+        missing = [name for name in dict.fromkeys(names) if name not in cache]
+        if missing:
+            from pypinyin import lazy_pinyin, Style
+            for name, zh_tw in zip(missing, s2t.batch(missing)):
+                cache[name] = [
+                    zh_tw,
+                    ''.join(lazy_pinyin(name)),
+                    ''.join(lazy_pinyin(name, style=Style.FIRST_LETTER))
+                ]
+            self.dirty = True
+        return cache
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        tmp.write_text(json.dumps({'version': self.version, 'names': self.names}, ensure_ascii=False),
+                       encoding='utf-8')
+        tmp.replace(self.path)
+        self.dirty = False
@@ -0,0 +1,131 @@
+from collections import Counter
+from typing import List, Tuple
+
+from .constance import lang_order
+
+magic = b'MTRP'
+format_version = 1
+
+
+def write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(byte: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        b = byte[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+def write_string(out: bytearray, string: str):
+    raw = string.encode('utf-8')
+    write_varint(out, len(raw))
+    out += raw
+
+
+def read_string(byte: bytes, pos: int) -> Tuple[str, int]:
+    length, pos = read_varint(byte, pos)
+    return byte[pos:pos + length].decode('utf-8'), pos + length
+
+
+def pack(data: dict, version: str) -> bytes:
+    """Encode a series document (Resource.data) with an interned string table.
+
+    Layout, every integer a LEB128 varint and every string varint length + utf-8:
+    magic, format version, series version, shared strings, lang count, char count,
+    then per char: id, one reference per lang, avatar count and references,
+    tag count and references. A reference is 0 for an absent name, 1 followed by
+    an inline string used only once, or shared string index + 2.
+    """
+    counter = Counter()
+    for names, avatars, tags in data.values():
+        counter.update(name for name in names if name)
+        counter.update(avatars)
+        counter.update(tags)
+    # repeated strings are interned, the most frequent get the shortest indexes
+    shared: List[str] = sorted((string for string, count in counter.items() if count > 1),
+                               key=lambda x: (-counter[x], x))
+    index = {string: i + 2 for i, string in enumerate(shared)}
+
+    out = bytearray(magic)
+
+    def write_ref(string):
+        if string == 0:
+            out.append(0)
+        elif string in index:
+            write_varint(out, index[string])
+        else:
+            out.append(1)
+            write_string(out, string)
+
+    write_varint(out, format_version)
+    write_string(out, version)
+    write_varint(out, len(shared))
+    for string in shared:
+        write_string(out, string)
+    write_varint(out, len(lang_order))
+    write_varint(out, len(data))
+    for char_id, (names, avatars, tags) in data.items():
+        write_string(out, char_id)
+        for name in names:
+            write_ref(name)
+        write_varint(out, len(avatars))
+        for avatar in avatars:
+            write_ref(avatar)
+        write_varint(out, len(tags))
+        for tag in tags:
+            write_ref(tag)
+    return bytes(out)
+
+
+def unpack(byte: bytes) -> Tuple[str, dict]:
+    """Decode pack output back to (version, Resource.data)."""
+    if byte[:len(magic)] != magic:
+        raise ValueError('not a packed series document')
+    pos = len(magic)
+    fmt, pos = read_varint(byte, pos)
+    if fmt != format_version:
+        raise ValueError(f'unsupported packed format {fmt}')
+    version, pos = read_string(byte, pos)
+
+    count, pos = read_varint(byte, pos)
+    strings = [0, None]
+    for _ in range(count):
+        string, pos = read_string(byte, pos)
+        strings.append(string)
+
+    def read_ref(pos):
+        ref, pos = read_varint(byte, pos)
+        if ref == 1:
+            return read_string(byte, pos)
+        return strings[ref], pos
+
+    langs, pos = read_varint(byte, pos)
+    count, pos = read_varint(byte, pos)
+    data = {}
+    for _ in range(count):
+        char_id, pos = read_string(byte, pos)
+        names = []
+        for _ in range(langs):
+            name, pos = read_ref(pos)
+            names.append(name)
+        avatars = []
+        length, pos = read_varint(byte, pos)
+        for _ in range(length):
+            avatar, pos = read_ref(pos)
+            avatars.append(avatar)
+        tags = []
+        length, pos = read_varint(byte, pos)
+        for _ in range(length):
+            tag, pos = read_ref(pos)
+            tags.append(tag)
+        data[char_id] = [names, avatars, tags]
+    return version, data
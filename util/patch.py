@@ -0,0 +1,28 @@
+from typing import List
+
+
+def diff_data(old: dict, new: dict) -> dict:
+    """Entries added, changed and removed between two series documents."""
+    return {
+        'added': {char_id: entry for char_id, entry in new.items() if char_id not in old},
+        'changed': {char_id: entry for char_id, entry in new.items() if char_id in old and old[char_id] != entry},
+        'removed': sorted(char_id for char_id in old if char_id not in new)
+    }
+
+
+def apply_patch(data: dict, patch: dict) -> dict:
+    data = dict(data)
+    for char_id in patch['removed']:
+        data.pop(char_id, None)
+    data.update(patch['added'])
+    data.update(patch['changed'])
+    return dict(sorted(data.items(), key=lambda x: x[0]))
+
+
+def patch_chain(index: dict, version: str) -> List[dict]:
+    """Patches a client at version has to apply in order, empty when version is not in the chain."""
+    patches = index.get('patches', [])
+    for i, patch in enumerate(patches):
+        if patch['from'] == version:
+            return patches[i:]
+    return []
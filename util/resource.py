@@ -1,240 +1,629 @@
-import os
-import json
-import aiohttp
-import hashlib
-from io import BytesIO
-from urllib.parse import quote
-from typing import Awaitable, Dict, List, Set, Optional, Union
-
-from PIL import Image
-
-from .constance import *
-from .upload import Uploader
-from .time import get_time
-
-
-class ServerError(Exception):
-    pass
-
-
-class Avatar:
-    prefix = 'avatar/'
-
-    def __init__(self, char_id: str, series: str, avatar_id: str):
-        self.char_id: str = char_id
-        self.series: str = series
-        self.id: str = avatar_id
-
-        self.raw: str = f'{self.prefix}{self.series}/{self.id}'
-        self.full: str = quote(self.raw)
-        self.short: str = avatar_id.replace(char_id, '') if char_id in avatar_id else 'id:' + avatar_id
-
-    def __repr__(self):
-        return self.id
-
-
-class Character:
-    def __init__(self, char_id: str, series: str, /, special: bool = False):
-        self.series: str = series
-        self.id: str = char_id
-        self.names: Dict[str, str] = {}
-        self.avatars: Dict[str, Avatar] = {}
-        self.type: Set[str] = set()
-        self.tags: List[str] = []
-        self.special = special
-
-    def add_name(self, lang: str, name: str):
-        self.names[lang] = name
-
-    def add_avatar(self, avatar: str):
-        self.avatars[avatar] = Avatar(self.id, self.series, avatar)
-
-    def add_type(self, _type: str):
-        self.type.add(_type)
-
-    def add_tag(self, tag: str):
-        if tag not in self.tags:
-            self.tags.append(tag)
-
-    @property
-    def hash(self) -> str:
-        return 'name:' + ','.join(sorted(self.names.values())) \
-            + ' avatars:' + ','.join(sorted(self.avatars.keys())) \
-            + ' types:' + ','.join(sorted(self.type)) \
-            + ' tags:' + ','.join(self.tags)
-
-    @property
-    def is_invalid(self):
-        return not self.avatars or not self.names
-
-    def __repr__(self):
-        return f'{self.id} names:{self.names} avatars:{self.avatars}'
-
-
-class Resource:
-    char_model = Character
-
-    def __init__(self, series: str):
-        self.series = series
-        self.chars: Dict[str, Character] = {}
-        self.client: Optional[aiohttp.ClientSession] = None
-        self.upload: Optional[Uploader] = None
-
-    async def req(self, url: str, target: str, byte: bool = False, **kwargs) -> Union[str, bytes]:
-        async with self.client.get(url, **kwargs) as r:
-            if r.status != 200:
-                if r.status == 404:
-                    raise FileNotFoundError(f'get {self.series} {target} failed {url} response 404')
-                elif 500 <= r.status < 600:
-                    raise ServerError(r.status)
-                else:
-                    raise AssertionError(f'get {self.series} {target} failed {url} {r.status}')
-            return await r.read() if byte else await r.text()
-
-    async def json(self, url: str, target: str, **kwargs):
-        return json.loads(await self.req(url, target, **kwargs))
-
-    @property
-    def remote_version(self) -> Awaitable[str]:
-        return self.req(static_url + version_url % self.series, 'version',
-                        headers={'Referer': 'https://www.mayertalk.top'})
-
-    async def _remote_data(self):
-        data = await self.json(static_url + data_url % self.series, 'data',
-                               headers={'Referer': 'https://www.mayertalk.top'})
-        return self.parse_data(data)
-
-    @property
-    def remote_data(self) -> Awaitable[dict]:
-        return self._remote_data()
-
-    @property
-    def special_char(self) -> Awaitable[dict]:
-        return self.json(static_url + special_data_url % self.series, 'special_data',
-                         headers={'Referer': 'https://www.mayertalk.top'})
-
-    def char(self, char_id, /, special: bool = False) -> Character:
-        if char_id not in self.chars:
-            self.chars[char_id] = self.char_model(char_id, self.series, special=special)
-        return self.chars[char_id]
-
-    def clean(self):
-        for char_id, char in self.chars.copy().items():
-            if char.is_invalid:
-                self.chars.pop(char_id)
-                print(f'[WARNING] invalid {self.series} char {char_id}')
-
-    @property
-    def version(self) -> str:
-        string = ''.join(char.hash for char in sorted(self.chars.values(), key=lambda x: x.id))
-        return hashlib.md5(string.encode('utf-8')).hexdigest()
-
-    @property
-    def data(self) -> dict:
-        return {
-            char_id: [
-                # 0-names
-                [data.names.get(i, 0) for i in lang_order],
-                # 1-avatars,
-                [data.avatars[i].short for i in sorted(data.avatars.keys())],
-                # 2-tags
-                data.tags
-            ]
-            for char_id, data in sorted(self.chars.items(), key=lambda x: x[0])
-        }
-
-    @staticmethod
-    def parse_data(data: dict) -> dict:
-        return {k: {
-            'names': {lang_order[i]: v2 for i, v2 in enumerate(v[0]) if v2},
-            'avatars': v[1],
-            'tags': v[2]
-        } for k, v in data.items()}
-
-    async def run(self):
-        self.client = aiohttp.ClientSession()
-
-        try:
-            res = await self.special_char
-        except (AssertionError, FileNotFoundError, ServerError):
-            res = {}
-
-        for char_id, data in res.items():
-            char = self.char(char_id, special=True)
-            for lang, name in data['names'].items():
-                char.add_name(lang, name)
-            for i, url in enumerate(data['avatars']):
-                char.avatars[str(i)] = Avatar(char_id, self.series, url)
-            print(f'special char {self.series} {char.id}')
-
-    async def get_avatar_data(self, char: Character, avatar: str) -> bytes:
-        ...
-
-    async def upload_avatar(self, char: Character, avatar: str):
-        try:
-            byte = await self.get_avatar_data(char, avatar)
-            im = Image.open(BytesIO(byte))
-            out_put = BytesIO()
-            im.save(out_put, 'webp')
-            out_put.seek(0)
-            await self.upload(char.avatars[avatar].raw + '.png', byte)
-            await self.upload(char.avatars[avatar].raw + '.webp', out_put.read())
-            print(f'upload {self.series} {char.avatars[avatar].raw}')
-        except FileNotFoundError as e:
-            print(f'upload {self.series} {char.avatars[avatar].raw} failed {e.args[0]}')
-            char.avatars.pop(avatar)
-        except ServerError as e:
-            print(f'get {self.series} {char.avatars[avatar].raw} failed server error {e.args[0]}')
-
-    async def update(self):
-        self.clean()
-        self.upload = Uploader(self.client)
-        version = self.version
-        remote_version = await self.remote_version
-        if remote_version == version:
-            print(f'pass {self.series} {version}')
-            return
-
-        print(f'update {self.series} {version}')
-        remote_data = await self.remote_data
-        for char_id, char in self.chars.items():
-            if char.special:
-                continue
-            if char_id in remote_data:
-                for avatar, url in char.avatars.copy().items():
-                    if url.short not in remote_data[char_id]['avatars']:
-                        await self.upload_avatar(char, avatar)
-            else:
-                for avatar, url in char.avatars.copy().items():
-                    await self.upload_avatar(char, avatar)
-
-        self.clean()
-
-        version = self.version
-        if version == remote_version:
-            # 因为char avatar上传失败，char list发生变动，使得version与云端一致
-            print(f'update {self.series} failed (same pass)')
-            return
-        await self.upload(version_url % self.series, version.encode('utf-8'))
-        print(f'upload {self.series} version {version}')
-
-        data = self.data
-        await self.upload(data_url % self.series, json.dumps(data, ensure_ascii=False).encode('utf-8'))
-        print(f'upload {self.series} data')
-
-        if not os.path.exists('data'):
-            os.mkdir('data')
-        if not os.path.exists('version'):
-            os.mkdir('version')
-
-        with open(f'data/{self.series}.json', mode='wt', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-
-        with open(f'version/{self.series}.txt', mode='wt', encoding='utf-8') as f:
-            f.write(version)
-
-        os.system('git add data')
-        os.system('git add version')
-        os.system(
-            f'git commit -m "[{self.series[0].upper() + self.series[1:]} UPDATE] Data:{get_time()}-{version[:6]}"')
-        os.system('echo "update=1" >> $GITHUB_ENV')
+import os
+import json
+import asyncio
+import aiohttp
+import hashlib
+from urllib.parse import quote
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Set, Optional, Tuple, Union
+
+from .constance import *
+from .cache import BlobCache, ResponseCache, git_blob_sha
+from . import metrics
+from .decode import JSONDecoder, decoder
+from .fetch import Fetcher, FetchResponse, fetcher
+from .git import GitChanges, changes
+from .image import ImageEncoder, ImageError, Variant
+from .packed import pack
+from .patch import diff_data
+from .stream import ObjectStream, iter_object
+from .ledger import UploadLedger, ledger
+from .upload import Uploader, UploadError
+from .time import get_time
+
+
+class ServerError(Exception):
+    pass
+
+
+class Avatar:
+    prefix = 'avatar/'
+
+    def __init__(self, char_id: str, series: str, avatar_id: str):
+        self.char_id: str = char_id
+        self.series: str = series
+        self.id: str = avatar_id
+
+        self.raw: str = f'{self.prefix}{self.series}/{self.id}'
+        self.full: str = quote(self.raw)
+        self.short: str = avatar_id.replace(char_id, '') if char_id in avatar_id else 'id:' + avatar_id
+
+    def __repr__(self):
+        return self.id
+
+
+class Character:
+    def __init__(self, char_id: str, series: str, /, special: bool = False):
+        self.series: str = series
+        self.id: str = char_id
+        self.names: Dict[str, str] = {}
+        self.avatars: Dict[str, Avatar] = {}
+        self.type: Set[str] = set()
+        self.tags: List[str] = []
+        self.special = special
+        # cached md5 of hash, None once names/avatars/types/tags changed
+        self._digest: Optional[str] = None
+
+    def add_name(self, lang: str, name: str):
+        if self.names.get(lang) != name:
+            self.names[lang] = name
+            self._digest = None
+
+    def add_avatar(self, avatar: str):
+        self.set_avatar(avatar, Avatar(self.id, self.series, avatar))
+
+    def set_avatar(self, key: str, avatar: Avatar):
+        if key not in self.avatars:
+            self._digest = None
+        self.avatars[key] = avatar
+
+    def remove_avatar(self, key: str):
+        if self.avatars.pop(key, None) is not None:
+            self._digest = None
+
+    def add_type(self, _type: str):
+        if _type not in self.type:
+            self.type.add(_type)
+            self._digest = None
+
+    def add_tag(self, tag: str):
+        if tag not in self.tags:
+            self.tags.append(tag)
+            self._digest = None
+
+    @property
+    def hash(self) -> str:
+        return 'name:' + ','.join(sorted(self.names.values())) \
+            + ' avatars:' + ','.join(sorted(self.avatars.keys())) \
+            + ' types:' + ','.join(sorted(self.type)) \
+            + ' tags:' + ','.join(self.tags)
+
+    @property
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = hashlib.md5(self.hash.encode('utf-8')).hexdigest()
+        return self._digest
+
+    @property
+    def is_invalid(self):
+        return not self.avatars or not self.names
+
+    def __repr__(self):
+        return f'{self.id} names:{self.names} avatars:{self.avatars}'
+
+
+class Resource:
+    char_model = Character
+    concurrency = 16
+    encode_workers: Optional[int] = None
+    # downscaled webp published next to every avatar, one per size
+    avatar_variants: Tuple[Variant, ...] = (Variant(48), Variant(96), Variant(160, quality=90))
+    patch_history = 8
+
+    def __init__(self, series: str):
+        self.series = series
+        self.chars: Dict[str, Character] = {}
+        self.fetch: Fetcher = fetcher
+        self.upload: Optional[Uploader] = None
+        self.encoder: Optional[ImageEncoder] = None
+        self.cache: BlobCache = BlobCache()
+        self.responses: ResponseCache = ResponseCache()
+        self.decoder: JSONDecoder = decoder
+        self.ledger: Optional[UploadLedger] = ledger
+        self.git: GitChanges = changes
+        # avatars that failed to upload for a reason other than missing upstream
+        self.failed: int = 0
+
+    def check(self, r: Union[FetchResponse, aiohttp.ClientResponse], url: str, target: str):
+        if r.status != 200:
+            if r.status == 404:
+                raise FileNotFoundError(f'get {self.series} {target} failed {url} response 404')
+            elif 500 <= r.status < 600:
+                raise ServerError(r.status)
+            else:
+                raise AssertionError(f'get {self.series} {target} failed {url} {r.status}')
+
+    async def req(self, url: str, target: str, byte: bool = False, cache: bool = False,
+                  **kwargs) -> Union[str, bytes]:
+        """Get url; with cache, send the stored validators and reuse the stored body on 304."""
+        if cache:
+            kwargs['headers'] = {**kwargs.get('headers', {}), **self.responses.validators(url)}
+        r = await self.fetch.get(url, **kwargs)
+        if cache and r.status == 304:
+            print(f'get {self.series} {target} not modified')
+            body = self.responses.body(url)
+            return body if byte else body.decode('utf-8')
+        self.check(r, url, target)
+        if cache:
+            self.responses.put(url, r.body, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return r.body if byte else r.text()
+
+    async def table(self, url: str, target: str, select: Callable[[str, Any], Any],
+                    descend: Iterable[str] = (), cache: bool = False) -> dict:
+        """Stream the json object at url and keep select(key, value) for every item it does not map to None.
+
+        The body is decoded chunk by chunk, only the selected fields stay in memory. With cache,
+        the selection is stored per select function and reused while the body is unchanged.
+        """
+        result = {}
+
+        def collect(items):
+            for key, value in items:
+                value = select(key, value)
+                if value is not None:
+                    result[key] = value
+
+        headers = self.responses.validators(url) if cache else {}
+        async with self.fetch.stream(url, headers) as r:
+            if cache and r.status == 304:
+                print(f'get {self.series} {target} not modified')
+                sha1 = self.responses.meta(url)['sha1']
+                cached = self.responses.load_result(url, select.__name__, sha1)
+                if cached is not None:
+                    return cached
+                collect(iter_object(self.responses.chunks(url), descend))
+                self.responses.save_result(url, select.__name__, sha1, result)
+                return result
+
+            self.check(r, url, target)
+            stream = ObjectStream(descend)
+            writer = self.responses.writer(url) if cache else None
+            try:
+                async for chunk in r.content.iter_chunked(1 << 16):
+                    if writer is not None:
+                        writer.write(chunk)
+                    collect(stream.feed(chunk))
+                collect(stream.feed(b'', True))
+            except BaseException:
+                if writer is not None:
+                    writer.abort()
+                raise
+            if writer is not None:
+                sha1 = writer.commit(r.headers.get('ETag'), r.headers.get('Last-Modified'))
+                self.responses.save_result(url, select.__name__, sha1, result)
+        return result
+
+    async def json(self, url: str, target: str, cache: bool = False, **kwargs):
+        if cache:
+            return await self.responses.parse(url, await self.req(url, target, True, cache=True, **kwargs),
+                                              self.decoder.loads)
+        return await self.decoder.loads(await self.req(url, target, True, **kwargs))
+
+    @property
+    def remote_version(self) -> Awaitable[str]:
+        return self.req(static_url + version_url % self.series, 'version',
+                        headers={'Referer': 'https://www.mayertalk.top'})
+
+    @property
+    def remote_raw_data(self) -> Awaitable[dict]:
+        return self.json(static_url + data_url % self.series, 'data',
+                         headers={'Referer': 'https://www.mayertalk.top'})
+
+    async def _remote_data(self):
+        return self.parse_data(await self.remote_raw_data)
+
+    @property
+    def remote_data(self) -> Awaitable[dict]:
+        return self._remote_data()
+
+    async def remote_patch_index(self) -> dict:
+        try:
+            return await self.json(static_url + patch_index_url % self.series, 'patch_index',
+                                   headers={'Referer': 'https://www.mayertalk.top'})
+        except (AssertionError, FileNotFoundError, ServerError):
+            return {'version': None, 'patches': []}
+
+    @property
+    def special_char(self) -> Awaitable[dict]:
+        return self.json(static_url + special_data_url % self.series, 'special_data',
+                         headers={'Referer': 'https://www.mayertalk.top'})
+
+    def char(self, char_id, /, special: bool = False) -> Character:
+        if char_id not in self.chars:
+            self.chars[char_id] = self.char_model(char_id, self.series, special=special)
+        return self.chars[char_id]
+
+    def clean(self):
+        for char_id, char in self.chars.copy().items():
+            if char.is_invalid:
+                self.chars.pop(char_id)
+                print(f'[WARNING] invalid {self.series} char {char_id}')
+
+    @property
+    def digests(self) -> Dict[str, str]:
+        """Char id -> digest, the leaves of the version tree."""
+        return {char_id: self.chars[char_id].digest for char_id in sorted(self.chars)}
+
+    def changed(self, previous: Dict[str, str]) -> Set[str]:
+        """Ids added, removed or changed since a previous digests snapshot."""
+        digests = self.digests
+        return {char_id for char_id in digests.keys() | previous.keys() if digests.get(char_id) != previous.get(char_id)}
+
+    @property
+    def version(self) -> str:
+        # only chars changed since their last digest are hashed again, the root is over the leaf digests
+        string = ''.join(f'{char_id}:{digest}\n' for char_id, digest in self.digests.items())
+        return hashlib.md5(string.encode('utf-8')).hexdigest()
+
+    @property
+    def data(self) -> dict:
+        return {
+            char_id: [
+                # 0-names
+                [data.names.get(i, 0) for i in lang_order],
+                # 1-avatars,
+                [data.avatars[i].short for i in sorted(data.avatars.keys())],
+                # 2-tags
+                data.tags
+            ]
+            for char_id, data in sorted(self.chars.items(), key=lambda x: x[0])
+        }
+
+    @staticmethod
+    def parse_data(data: dict) -> dict:
+        return {k: {
+            'names': {lang_order[i]: v2 for i, v2 in enumerate(v[0]) if v2},
+            'avatars': v[1],
+            'tags': v[2]
+        } for k, v in data.items()}
+
+    async def run(self):
+        try:
+            res = await self.special_char
+        except (AssertionError, FileNotFoundError, ServerError):
+            res = {}
+
+        for char_id, data in res.items():
+            char = self.char(char_id, special=True)
+            for lang, name in data['names'].items():
+                char.add_name(lang, name)
+            for i, url in enumerate(data['avatars']):
+                char.set_avatar(str(i), Avatar(char_id, self.series, url))
+            print(f'special char {self.series} {char.id}')
+
+    async def get_avatar_data(self, char: Character, avatar: str) -> bytes:
+        ...
+
+    def avatar_sha(self, char: Character, avatar: str) -> Optional[str]:
+        """Upstream git blob sha of an avatar image, None when unknown."""
+        return None
+
+    async def avatar_bytes(self, char: Character, avatar: str) -> Tuple[bytes, bytes, Dict[Variant, bytes]]:
+        """Png, webp and variant bytes of an avatar, served from the blob cache when possible."""
+        sha = self.avatar_sha(char, avatar)
+        png = self.cache.get(sha, 'png') if sha else None
+        if png is None:
+            png = await self.get_avatar_data(char, avatar)
+            if sha and git_blob_sha(png) != sha:
+                # upstream changed since the tree listing, do not cache under a stale sha
+                sha = None
+            if sha:
+                self.cache.put(sha, 'png', png)
+
+        webp = self.cache.get(sha, 'webp') if sha else None
+        variants = {variant: self.cache.get(sha, variant.kind) for variant in self.avatar_variants} if sha else {}
+        if webp is None or len(variants) < len(self.avatar_variants) or None in variants.values():
+            # one decode encodes them all, a single missing variant encodes everything again
+            png, webp, variants = await self.encoder(png)
+            if sha:
+                self.cache.put(sha, 'webp', webp)
+                for variant, byte in variants.items():
+                    self.cache.put(sha, variant.kind, byte)
+        return png, webp, variants
+
+    async def upload_avatar(self, char: Character, avatar: str, semaphore: asyncio.Semaphore) -> Optional[bool]:
+        """Upload one avatar.
+
+        Return True once uploaded, False when its image does not exist upstream
+        or cannot be decoded, and None when it failed for another reason and
+        should be retried later.
+        """
+        async with semaphore:
+            try:
+                png, webp, variants = await self.avatar_bytes(char, avatar)
+                raw = char.avatars[avatar].raw
+                results = await asyncio.gather(
+                    self.upload(raw + '.png', png),
+                    self.upload(raw + '.webp', webp),
+                    *[self.upload(raw + variant.suffix, byte) for variant, byte in variants.items()]
+                )
+                for result in results:
+                    if not result:
+                        print(f'upload {self.series} {char.avatars[avatar].raw} failed {result.error}')
+                        return None
+                print(f'upload {self.series} {char.avatars[avatar].raw}')
+            except (FileNotFoundError, ImageError) as e:
+                # fails the same way on every run, dropped instead of blocking the series
+                print(f'upload {self.series} {char.avatars[avatar].raw} failed {e.args[0]}')
+                return False
+            except ServerError as e:
+                print(f'get {self.series} {char.avatars[avatar].raw} failed server error {e.args[0]}')
+                return None
+            except Exception as e:
+                # a 403, a connection error after retries or a corrupt image must not abort the series
+                print(f'upload {self.series} {char.avatars[avatar].raw} failed {type(e).__name__}: {e}')
+                return None
+            return True
+
+    def load_manifest(self) -> Optional[Dict[str, str]]:
+        """Avatar id -> upstream blob sha of the last uploaded image, None before the first run."""
+        if not os.path.exists(f'version/{self.series}.avatars.json'):
+            return None
+        with open(f'version/{self.series}.avatars.json', mode='rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest: Dict[str, str]):
+        if not os.path.exists('version'):
+            os.mkdir('version')
+        with open(f'version/{self.series}.avatars.json', mode='wt', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    @property
+    def variants_document(self) -> dict:
+        return {'variants': [variant.document for variant in self.avatar_variants]}
+
+    def load_variants(self) -> Optional[dict]:
+        """Variant settings every uploaded avatar was encoded with, None before the first run."""
+        if not os.path.exists(f'version/{self.series}.variants.json'):
+            return None
+        with open(f'version/{self.series}.variants.json', mode='rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    async def publish_variants(self, document: dict):
+        """Publish the variant list clients build avatar urls from, and record it."""
+        await self.publish(variants_url % self.series,
+                           json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        if not os.path.exists('version'):
+            os.mkdir('version')
+        with open(f'version/{self.series}.variants.json', mode='wt', encoding='utf-8') as f:
+            json.dump(document, f, indent=2)
+            f.write('\n')
+        print(f'upload {self.series} avatar variants ({len(document["variants"])})')
+
+    def avatar_manifest(self, previous: Optional[Dict[str, str]], pending: List[tuple]) -> Dict[str, str]:
+        """Manifest of the avatars already on the remote; pending ones keep their previous sha."""
+        pending = {(char.id, avatar) for char, avatar in pending}
+        previous = previous or {}
+        manifest = {}
+        for char in self.chars.values():
+            if char.special:
+                continue
+            for avatar in char.avatars:
+                if (char.id, avatar) in pending:
+                    sha = previous.get(avatar)
+                else:
+                    # keep the recorded sha when the tree listing is unavailable this run
+                    sha = self.avatar_sha(char, avatar) or previous.get(avatar)
+                if sha:
+                    manifest[avatar] = sha
+        return manifest
+
+    def pending_avatars(self, remote_data: Optional[dict], manifest: Optional[Dict[str, str]] = None) -> List[tuple]:
+        """List (char, avatar) pairs whose avatar is not on the remote yet or whose image changed.
+
+        remote_data None means the remote holds the same avatars as local. Without a
+        manifest, images already on the remote are assumed to be up to date.
+        """
+        pending = []
+        for char_id, char in self.chars.items():
+            if char.special:
+                continue
+            if remote_data is None:
+                remote_avatars = None
+            else:
+                remote_avatars = remote_data[char_id]['avatars'] if char_id in remote_data else ()
+            for avatar, url in char.avatars.items():
+                if remote_avatars is not None and url.short not in remote_avatars:
+                    pending.append((char, avatar))
+                elif manifest is not None:
+                    sha = self.avatar_sha(char, avatar)
+                    if sha and manifest.get(avatar) != sha:
+                        pending.append((char, avatar))
+        return pending
+
+    async def upload_avatars(self, pending: List[tuple], manifest: Optional[Dict[str, str]] = None) -> int:
+        """Upload avatars concurrently, then drop the ones missing upstream.
+
+        Avatars are only removed once every task has finished, never while iterating.
+        The sha of every uploaded avatar is recorded in manifest.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        self.encoder = ImageEncoder(self.encode_workers, self.avatar_variants)
+        try:
+            results = await asyncio.gather(*[
+                self.upload_avatar(char, avatar, semaphore)
+                for char, avatar in pending
+            ])
+        finally:
+            self.encoder.close()
+        dropped = 0
+        self.failed += results.count(None)
+        for (char, avatar), ok in zip(pending, results):
+            if ok is False:
+                char.remove_avatar(avatar)
+                if manifest is not None:
+                    manifest.pop(avatar, None)
+                dropped += 1
+            elif ok and manifest is not None:
+                sha = self.avatar_sha(char, avatar)
+                if sha:
+                    manifest[avatar] = sha
+        return dropped
+
+    async def publish(self, path: str, byte: bytes):
+        """Upload a file the series cannot be published without, raise UploadError on failure."""
+        result = await self.upload(path, byte)
+        if not result:
+            raise UploadError(f'upload {self.series} {path} failed {result.error}')
+
+    def shards(self, data: dict) -> Dict[str, dict]:
+        """Shard name -> the entries of data in it: 'special' for special chars, else the first tag."""
+        shards = {}
+        for char_id, entry in data.items():
+            if self.chars[char_id].special:
+                name = 'special'
+            else:
+                name = entry[2][0] if entry[2] else 'other'
+            shards.setdefault(name, {})[char_id] = entry
+        return shards
+
+    def load_shard_manifest(self) -> Optional[dict]:
+        if not os.path.exists(f'data/{self.series}.shards.json'):
+            return None
+        with open(f'data/{self.series}.shards.json', mode='rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_shard_manifest(self, manifest: dict):
+        if not os.path.exists('data'):
+            os.mkdir('data')
+        with open(f'data/{self.series}.shards.json', mode='wt', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    async def publish_shards(self, data: dict, version: str) -> dict:
+        """Upload the shards whose hash changed since the last manifest, then the new manifest."""
+        previous = (self.load_shard_manifest() or {}).get('shards', {})
+        manifest = {'version': version, 'shards': {}}
+        uploads = []
+        for name, entries in sorted(self.shards(data).items()):
+            byte = json.dumps(entries, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            digest = hashlib.md5(byte).hexdigest()
+            path = shard_url % (self.series, name)
+            manifest['shards'][name] = {'path': path, 'hash': digest, 'count': len(entries), 'size': len(byte)}
+            if previous.get(name, {}).get('hash') != digest:
+                uploads.append(self.publish(path, byte))
+        # shards go first, the manifest never lists a hash that is not uploaded yet
+        await asyncio.gather(*uploads)
+        await self.publish(shard_manifest_url % self.series,
+                           json.dumps(manifest, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        print(f'upload {self.series} shards ({len(uploads)}/{len(manifest["shards"])} changed)')
+        return manifest
+
+    async def upload_patch(self, remote_version: str, remote_raw_data: dict, version: str, data: dict):
+        """Publish the patch from remote_version to version and append it to the patch index."""
+        patch = {'from': remote_version, 'to': version, **diff_data(remote_raw_data, data)}
+        byte = json.dumps(patch, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        await self.publish(patch_url % (self.series, remote_version), byte)
+
+        index = await self.remote_patch_index()
+        patches = index['patches'] if index.get('version') == remote_version else []
+        patches = patches + [{'from': remote_version, 'to': version, 'size': len(byte)}]
+        index = {'version': version, 'patches': patches[-self.patch_history:]}
+        await self.publish(patch_index_url % self.series,
+                           json.dumps(index, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        print(f'upload {self.series} patch {remote_version[:6]}-{version[:6]} ({len(byte)} bytes)')
+
+    def commit(self, version: str):
+        self.git.add(f'[{self.series[0].upper() + self.series[1:]} UPDATE] Data:{get_time()}-{version[:6]}',
+                     'data', 'version')
+
+    async def update(self):
+        # a runner may hand in an uploader shared by every series
+        own = self.upload is None
+        if own:
+            self.upload = Uploader(ledger=self.ledger)
+        try:
+            await self._update()
+        finally:
+            if own:
+                await self.upload.close()
+                self.upload = None
+
+    async def _update(self):
+        with metrics.phase('compare'):
+            self.clean()
+            version = self.version
+            remote_version = await self.remote_version
+            previous_manifest = self.load_manifest()
+            remote_raw_data = None if remote_version == version else await self.remote_raw_data
+            remote_data = None if remote_raw_data is None else self.parse_data(remote_raw_data)
+            pending = self.pending_avatars(remote_data, previous_manifest)
+            variants = self.variants_document
+            variants_changed = self.load_variants() != variants
+            if variants_changed:
+                # avatars uploaded before lack the new variants
+                pending = self.pending_avatars({})
+        shard_manifest = self.load_shard_manifest()
+        if (remote_data is None and not pending and previous_manifest is not None
+                and shard_manifest is not None and not variants_changed):
+            print(f'pass {self.series} {version}')
+            return
+
+        print(f'update {self.series} {version} ({len(pending)} avatars)')
+        manifest = self.avatar_manifest(previous_manifest, pending)
+        failed = self.failed
+        with metrics.phase('upload_avatars'):
+            await self.upload_avatars(pending, manifest)
+        # the list is only published once every avatar has its variants, else the next run queues them all again
+        variants_changed = variants_changed and self.failed == failed
+
+        self.clean()
+
+        version = self.version
+        if version == remote_version:
+            if shard_manifest is None or variants_changed:
+                # the data is published already, only its shards or the variant list are missing
+                with metrics.phase('publish'):
+                    if shard_manifest is None:
+                        self.save_shard_manifest(await self.publish_shards(self.data, version))
+                    if variants_changed:
+                        await self.publish_variants(variants)
+                self.save_manifest(manifest)
+                self.commit(version)
+                print(f'update {self.series} manifests {version}')
+            elif manifest != previous_manifest:
+                self.save_manifest(manifest)
+                self.commit(version)
+                print(f'update {self.series} avatars {version}')
+            else:
+                # 因为char avatar上传失败，char list发生变动，使得version与云端一致
+                print(f'update {self.series} failed (same pass)')
+            return
+
+        with metrics.phase('publish'):
+            data = self.data
+            # the patch goes first so that clients seeing the new version can find it
+            if remote_raw_data is None:
+                remote_raw_data = await self.remote_raw_data
+            await self.upload_patch(remote_version, remote_raw_data, version, data)
+            shard_manifest = await self.publish_shards(data, version)
+            if variants_changed:
+                await self.publish_variants(variants)
+
+            await self.publish(version_url % self.series, version.encode('utf-8'))
+            print(f'upload {self.series} version {version}')
+
+            await self.publish(data_url % self.series, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+            print(f'upload {self.series} data')
+
+            packed = pack(data, version)
+            await self.publish(packed_data_url % self.series, packed)
+            print(f'upload {self.series} packed data ({len(packed)} bytes)')
+
+            if not os.path.exists('data'):
+                os.mkdir('data')
+            if not os.path.exists('version'):
+                os.mkdir('version')
+
+            with open(f'data/{self.series}.json', mode='wt', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+
+            with open(f'data/{self.series}.bin', mode='wb') as f:
+                f.write(packed)
+
+            with open(f'version/{self.series}.txt', mode='wt', encoding='utf-8') as f:
+                f.write(version)
+
+            self.save_shard_manifest(shard_manifest)
+
+            self.save_manifest(manifest)
+            self.commit(version)
@@ -0,0 +1,66 @@
+import asyncio
+import traceback
+import tracemalloc
+from typing import List
+
+from . import metrics
+from .decode import decoder
+from .fetch import fetcher
+from .git import changes
+from .ledger import ledger
+from .upload import Uploader
+
+
+class Runner:
+    """Run every registered resource concurrently on one event loop.
+
+    Resources download through the shared fetcher pool and upload through one
+    Uploader, whose pool size is the upload budget of all series together.
+    A series that raises does not stop the others, the changes of the series
+    that finished are committed together once everything is done.
+    """
+
+    def __init__(self, upload_limit: int = Uploader.limit):
+        self.resources: list = []
+        self.upload_limit: int = upload_limit
+
+    def register(self, resource):
+        self.resources.append(resource)
+        return resource
+
+    async def run_resource(self, resource) -> bool:
+        try:
+            await resource.run()
+        except Exception:
+            print(f'[ERROR] update {resource.series} failed')
+            traceback.print_exc()
+            return False
+        return True
+
+    async def run(self) -> List[str]:
+        """Run every resource, return the series that failed."""
+        upload = Uploader(ledger=ledger)
+        upload.limit = self.upload_limit
+        for resource in self.resources:
+            resource.upload = upload
+        # traced for the whole run, so a series finishing first does not stop tracing for the others
+        tracing = metrics.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        try:
+            results = await asyncio.gather(*[self.run_resource(resource) for resource in self.resources])
+        finally:
+            if tracing:
+                tracemalloc.stop()
+            for resource in self.resources:
+                resource.upload = None
+            await upload.close()
+            await fetcher.close()
+            decoder.close()
+        return [resource.series for resource, ok in zip(self.resources, results) if not ok]
+
+    def start(self):
+        failed = asyncio.run(self.run())
+        changes.commit()
+        if failed:
+            raise SystemExit(f'update failed: {", ".join(failed)}')
@@ -0,0 +1,82 @@
+import re
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+separator = re.compile(r'[\s\-_·・()（）]+')
+# longest name suffix indexed for substring matches of cjk names
+max_suffix = 16
+
+
+def normalize(text: str) -> str:
+    return separator.sub(' ', text).strip().casefold()
+
+
+class SearchIndex:
+    """Name search over every lang_order field of a series document (Resource.data).
+
+    Results rank exact matches first, then names starting with the query, then
+    names with a word or, for cjk names, a substring starting with it. Lookups
+    bisect sorted key lists and stop at limit, so a query scans its matches
+    and never the whole series.
+    """
+
+    def __init__(self, data: dict):
+        self.ids: List[str] = list(data)
+        self.tags: List[frozenset] = [frozenset(tags) for _, _, tags in data.values()]
+        self.exact: Dict[str, List[int]] = {}
+        full_keys: List[str] = []
+        full_ids: List[int] = []
+        part_keys: List[str] = []
+        part_ids: List[int] = []
+        for i, (names, _, _) in enumerate(data.values()):
+            # zh_CN and zh_TW, or a name and its code, are often the same
+            keys = {normalize(str(name)) for name in names if name}
+            keys.discard('')
+            parts = {part for key in keys for part in self.parts(key)} - keys
+            for key in keys:
+                self.exact.setdefault(key, []).append(i)
+            full_keys.extend(keys)
+            full_ids.extend([i] * len(keys))
+            part_keys.extend(parts)
+            part_ids.extend([i] * len(parts))
+        self.full_keys, self.full_ids = self.sort(full_keys, full_ids)
+        self.part_keys, self.part_ids = self.sort(part_keys, part_ids)
+
+    @staticmethod
+    def sort(keys: List[str], ids: List[int]) -> Tuple[List[str], List[int]]:
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        return [keys[j] for j in order], [ids[j] for j in order]
+
+    @staticmethod
+    def parts(key: str) -> List[str]:
+        if key.isascii():
+            words = key.split(' ')
+            return [' '.join(words[i:]) for i in range(1, len(words))]
+        key = key.replace(' ', '')
+        return [key[i:i + max_suffix] for i in range(1, len(key))]
+
+    def search(self, query: str, limit: int = 20, tag: Optional[str] = None) -> List[str]:
+        """Ids of the chars matching query, best first."""
+        query = normalize(query)
+        result: List[str] = []
+        if not query or limit <= 0:
+            return result
+        seen = set()
+
+        def take(i: int) -> bool:
+            """Add a match, True once limit is reached."""
+            if i not in seen and (tag is None or tag in self.tags[i]):
+                seen.add(i)
+                result.append(self.ids[i])
+            return len(result) >= limit
+
+        for i in self.exact.get(query, ()):
+            if take(i):
+                return result
+        for keys, ids in ((self.full_keys, self.full_ids), (self.part_keys, self.part_ids)):
+            j = bisect_left(keys, query)
+            while j < len(keys) and keys[j].startswith(query):
+                if take(ids[j]):
+                    return result
+                j += 1
+        return result
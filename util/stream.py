@@ -0,0 +1,94 @@
+import re
+import json
+import codecs
+from typing import Any, Iterable, Iterator, Tuple
+
+whitespace = re.compile(r'[ \t\n\r]*')
+
+
+class ObjectStream:
+    """Decode the items of a json object incrementally from byte chunks.
+
+    Items are yielded as soon as their value is complete, so only one item is
+    held in memory at a time. Keys listed in descend are not yielded; the
+    stream walks into their object value and yields its items instead, e.g.
+    descend=('enemyData',) for enemy_handbook_table.json.
+    """
+
+    def __init__(self, descend: Iterable[str] = ()):
+        self.descend = set(descend)
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buffer: str = ''
+        self.pos: int = 0
+        # 'open': expect '{', 'key': expect a key or '}', 'value': expect ':' and a value,
+        # 'next': expect ',' or '}', 'end': the top-level object is closed
+        self.state: str = 'open'
+        self.depth: int = 0
+        self.key: str = ''
+
+    def feed(self, chunk: bytes, final: bool = False) -> Iterator[Tuple[str, Any]]:
+        self.buffer = self.buffer[self.pos:] + self.text.decode(chunk, final)
+        self.pos = 0
+        while self.state != 'end':
+            pos = whitespace.match(self.buffer, self.pos).end()
+            if pos == len(self.buffer):
+                break
+            char = self.buffer[pos]
+            if self.state == 'open':
+                self.expect(char, '{')
+                self.pos, self.depth, self.state = pos + 1, self.depth + 1, 'key'
+            elif self.state in ('key', 'next') and char == '}':
+                self.depth -= 1
+                self.pos, self.state = pos + 1, 'next' if self.depth else 'end'
+            elif self.state == 'next':
+                self.expect(char, ',')
+                self.pos, self.state = pos + 1, 'key'
+            elif self.state == 'key':
+                item = self.decode(pos, final)
+                if item is None:
+                    break
+                self.key, self.pos = item
+                self.state = 'value'
+            else:
+                self.expect(char, ':')
+                value_pos = whitespace.match(self.buffer, pos + 1).end()
+                if value_pos == len(self.buffer):
+                    break
+                if self.key in self.descend and self.buffer[value_pos] == '{':
+                    self.pos, self.state = value_pos, 'open'
+                    continue
+                item = self.decode(value_pos, final)
+                if item is None:
+                    break
+                value, self.pos = item
+                self.state = 'next'
+                if self.key not in self.descend:
+                    yield self.key, value
+        if final and self.state != 'end':
+            raise ValueError('incomplete json object')
+
+    def decode(self, pos: int, final: bool):
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return None
+        # a number at the end of the buffer may continue in the next chunk
+        if end == len(self.buffer) and not final:
+            return None
+        return value, end
+
+    @staticmethod
+    def expect(char: str, expected: str):
+        if char != expected:
+            raise ValueError(f'expect {expected!r} got {char!r}')
+
+
+def iter_object(chunks: Iterable[bytes], descend: Iterable[str] = ()) -> Iterator[Tuple[str, Any]]:
+    stream = ObjectStream(descend)
+    for chunk in chunks:
+        yield from stream.feed(chunk)
+    yield from stream.feed(b'', True)
+
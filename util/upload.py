@@ -1,30 +1,231 @@
-import os
-import time
-import hashlib
-import aiohttp
-
-from typing import Awaitable
-
-server = os.environ.get('SERVER')
-key = os.environ.get('KEY')
-
-class Uploader:
-    def __init__(self, client: aiohttp.ClientSession):
-        self.client = client
-
-    @property
-    def sign(self) -> dict:
-        ts = str(int(time.time()))
-        signature = hashlib.sha256(f'{key}MTS{ts}'.encode('utf-8')).hexdigest()
-        return {'signature': signature, 'timestamp': ts}
-
-    async def upload(self, path: str, file: bytes):
-        async with self.client.put(server, headers=self.sign, params={'path': path, 'site': 'static'},
-                                   data={'file': file}) as r:
-            assert r.ok, 'upload %s failed %s' % (path, r.status)
-            res = await r.json()
-            assert res['code'] == 200, 'upload %s failed [%s]' % (path, res['code'])
-            return True
-
-    def __call__(self, path: str, file: bytes) -> Awaitable:
-        return self.upload(path, file)
+import os
+import time
+import random
+import asyncio
+import hashlib
+import aiohttp
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+from . import metrics
+from .ledger import UploadLedger, content_sha
+
+server = os.environ.get('SERVER')
+key = os.environ.get('KEY')
+
+
+class UploadError(Exception):
+    pass
+
+
+@dataclass
+class UploadResult:
+    path: str
+    ok: bool
+    status: Optional[int] = None
+    error: Optional[str] = None
+    attempts: int = 1
+    skipped: bool = False
+
+    def __bool__(self):
+        return self.ok
+
+
+class RetryableError(Exception):
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status: Optional[int] = status
+
+
+class Uploader:
+    """Signed PUTs to the static server on a dedicated connection pool.
+
+    Failures are retried with exponential backoff and full jitter on 5xx/429 and
+    connection errors, and reported as an UploadResult instead of raising.
+    With batch_size > 1 small files are grouped into one multipart request with
+    batch=1; this needs an upload server answering {'code': 200, 'data': {path: code}},
+    a batch rejected with 4xx falls back to single uploads.
+    With a ledger, content already uploaded to the same path is skipped.
+    """
+    limit = 16
+    retries = 4
+    backoff = 0.5
+    timeout = aiohttp.ClientTimeout(total=120, sock_connect=10, sock_read=60)
+    batch_size = int(os.environ.get('UPLOAD_BATCH', 0))
+    batch_bytes = 256 * 1024
+    batch_delay = 0.05
+
+    def __init__(self, client: Optional[aiohttp.ClientSession] = None, ledger: Optional[UploadLedger] = None):
+        self.client: Optional[aiohttp.ClientSession] = client
+        self.ledger: Optional[UploadLedger] = ledger
+        self.own_client: bool = client is None
+        self.results: List[UploadResult] = []
+        self.pending: List[Tuple[str, bytes, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.tasks: Set[asyncio.Task] = set()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self.client is None:
+            self.client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit,
+                                               keepalive_timeout=30, ttl_dns_cache=300),
+                timeout=self.timeout
+            )
+        return self.client
+
+    @property
+    def sign(self) -> dict:
+        ts = str(int(time.time()))
+        signature = hashlib.sha256(f'{key}MTS{ts}'.encode('utf-8')).hexdigest()
+        return {'signature': signature, 'timestamp': ts}
+
+    @property
+    def failed(self) -> List[UploadResult]:
+        return [result for result in self.results if not result]
+
+    async def retry(self, path: str, send) -> UploadResult:
+        """Run send() until it succeeds, fails for good or runs out of retries."""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = await send()
+                result.attempts = attempt
+                return result
+            except (RetryableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+                if attempt > self.retries:
+                    return UploadResult(path, False, getattr(e, 'status', None), error, attempt)
+                delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+                print(f'retry upload {path} in {delay:.2f}s ({error})')
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def check(path: str, status: int):
+        if status >= 500 or status == 429:
+            raise RetryableError(f'upload {path} failed {status}', status)
+
+    @staticmethod
+    async def response(r: aiohttp.ClientResponse) -> Optional[dict]:
+        """Json object of an upload response, None for any other body."""
+        try:
+            res = await r.json(content_type=None)
+        except ValueError:
+            return None
+        return res if isinstance(res, dict) else None
+
+    async def upload(self, path: str, file: bytes) -> UploadResult:
+        async def send():
+            metrics.request(server, bytes_out=len(file))
+            async with self.session.put(server, headers=self.sign, params={'path': path, 'site': 'static'},
+                                        data={'file': file}) as r:
+                self.check(path, r.status)
+                if not r.ok:
+                    return UploadResult(path, False, r.status, f'upload {path} failed {r.status}')
+                res = await self.response(r)
+                if res is None:
+                    return UploadResult(path, False, r.status, f'upload {path} failed invalid response')
+                if res.get('code') != 200:
+                    return UploadResult(path, False, r.status, f'upload {path} failed [{res.get("code")}]')
+                return UploadResult(path, True, r.status)
+
+        result = await self.retry(path, send)
+        self.results.append(result)
+        return result
+
+    async def upload_batch(self, files: Dict[str, bytes]) -> List[UploadResult]:
+        """Upload several files in one request, falling back to single uploads when batches are refused."""
+        codes: Dict[str, int] = {}
+
+        async def send():
+            metrics.request(server, bytes_out=sum(len(file) for file in files.values()))
+            form = aiohttp.FormData()
+            for path, file in files.items():
+                form.add_field('path', path)
+                form.add_field('file', file, filename=path.rsplit('/', 1)[-1])
+            async with self.session.put(server, headers=self.sign, params={'site': 'static', 'batch': '1'},
+                                        data=form) as r:
+                self.check('batch', r.status)
+                if not r.ok:
+                    return UploadResult('batch', False, r.status, f'upload batch failed {r.status}')
+                res = await self.response(r)
+                if res is None:
+                    return UploadResult('batch', False, r.status, 'upload batch failed invalid response')
+                data = res.get('data') if res.get('code') == 200 else None
+                if not isinstance(data, dict):
+                    return UploadResult('batch', False, r.status, f'upload batch failed [{res.get("code")}]')
+                codes.update(data)
+                return UploadResult('batch', True, r.status)
+
+        batch = await self.retry('batch', send)
+        if not batch:
+            if batch.status is not None and 400 <= batch.status < 500:
+                print(f'upload batch refused {batch.status}, upload {len(files)} files one by one')
+                self.batch_size = 0
+                return list(await asyncio.gather(*[self.upload(path, file) for path, file in files.items()]))
+            results = [UploadResult(path, False, batch.status, batch.error, batch.attempts) for path in files]
+        else:
+            results = [
+                UploadResult(path, codes.get(path) == 200, batch.status,
+                             None if codes.get(path) == 200 else f'upload {path} failed [{codes.get(path)}]',
+                             batch.attempts)
+                for path in files
+            ]
+        self.results.extend(results)
+        return results
+
+    async def enqueue(self, path: str, file: bytes) -> UploadResult:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((path, file, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.batch_delay, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, []
+        if pending:
+            task = asyncio.ensure_future(self.send_batch(pending))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def send_batch(self, pending: List[Tuple[str, bytes, asyncio.Future]]):
+        try:
+            results = await self.upload_batch({path: file for path, file, _ in pending})
+        except Exception as e:
+            for _, _, future in pending:
+                future.set_exception(e)
+            return
+        results = {result.path: result for result in results}
+        for path, _, future in pending:
+            future.set_result(results[path])
+
+    async def close(self):
+        self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        if self.own_client and self.client is not None:
+            await self.client.close()
+            self.client = None
+        if self.ledger is not None:
+            self.ledger.save()
+
+    async def __call__(self, path: str, file: bytes) -> UploadResult:
+        sha = content_sha(file) if self.ledger is not None else None
+        if sha is not None and self.ledger.uploaded(path, sha):
+            result = UploadResult(path, True, attempts=0, skipped=True)
+            self.results.append(result)
+            return result
+        if self.batch_size > 1 and len(file) <= self.batch_bytes:
+            result = await self.enqueue(path, file)
+        else:
+            result = await self.upload(path, file)
+        if result and sha is not None:
+            self.ledger.record(path, sha)
+        return result